@@ -1,6 +1,6 @@
 import streamlit as st
 from pathlib import Path
-from article_info import Article_Info
+from article_info import get_shared_article_info
 from ivivi_facture_reader import IviviFactureReader
 from jessy_facture_reader import JessyFactureReader
 from dolvika_facture_reader import DolvikaFactureReader
@@ -8,19 +8,12 @@ from mod_facture_reader import ModFactureReader
 from sarl_zhc_facture_reader import SarlZhcFactureReader
 from zhc_facture_reader import ZhcFactureReader
 from loguru import logger
-import shutil
 import pandas as pd
-from io import BytesIO
+from io import BytesIO, StringIO
+import uuid
 
 # Streamlit App
-def main(output_folder_path, log_folder_path):
-
-    @st.cache_resource
-    def configure_logging(log_file_path):
-        # Clean up existing log file
-        if log_file_path.exists():
-            log_file_path.unlink()
-        logger.add(log_file_path, level="INFO")
+def main():
 
     st.title("PDF to XML Processor")
     st.write("Upload a PDF file to process and generate XML & logs.")
@@ -41,8 +34,8 @@ def main(output_folder_path, log_folder_path):
 
     article_info_excel = Path("data/DONNEES DOUANE PYTHON.xlsx")
 
-    # Load Article_Info
-    article_info = Article_Info(source_excel=article_info_excel)
+    # Article_Info shared by all the sessions, loaded again only when the workbook changes
+    article_info = get_shared_article_info(source_excel=article_info_excel)
 
     # File uploader
     uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
@@ -50,22 +43,23 @@ def main(output_folder_path, log_folder_path):
         st.session_state["process_done"] = False
 
     if uploaded_file is not None:
-        # Save the uploaded file to a temporary location
-        temp_pdf_path = output_folder_path / uploaded_file.name
-        with temp_pdf_path.open("wb") as f:
-            shutil.copyfileobj(uploaded_file, f)
-
-        # Process the PDF
+        # outputs kept in the session belong to one upload and company, another upload is processed again
+        upload_key = (uploaded_file.file_id, company_name)
+        if st.session_state.get("upload_key") != upload_key:
+            st.session_state["upload_key"] = upload_key
+            st.session_state["process_done"] = False
+            for output_key in ("excel_bytes", "xml_bytes", "log_bytes"):
+                st.session_state.pop(output_key, None)
+        # The upload is read from memory, and the outputs are kept in the session, nothing is written to disk
         st.write("Processing the PDF... It will take few minutes")
         try:
-            xml_file_path = output_folder_path / f"{temp_pdf_path.stem}.xml"
-            excel_file_path = output_folder_path / f"{temp_pdf_path.stem}.xlsx"
-            log_file_path = log_folder_path / f"{temp_pdf_path.stem}.log"
+            pdf_stem = Path(uploaded_file.name).stem
 
             reader = process_func(
-                pdf_path=temp_pdf_path, 
-                article_info=article_info, 
-                output_folder_path=output_folder_path
+                pdf_path=BytesIO(uploaded_file.getvalue()),
+                article_info=article_info,
+                output_folder_path=None,
+                pdf_name=uploaded_file.name,
             )
             if not reader.if_xml:
                 st.warning(f"No XML file will be generated for {reader.party.partyName}, only excel file will be generated")
@@ -74,62 +68,61 @@ def main(output_folder_path, log_folder_path):
             if not st.session_state["process_done"]:
                 logger.debug(f"start to process, as session_state process_done: {st.session_state['process_done']}")
                 with st.status("Running"):
-                    configure_logging(log_file_path)
-                    df = reader.run()
+                    log_buffer = StringIO()
+                    # the sink is process-wide, only the records of this run go to this session's log
+                    run_id = uuid.uuid4().hex
+                    handler_id = logger.add(log_buffer, level="INFO", filter=lambda record: record["extra"].get("run_id") == run_id)
+                    try:
+                        with logger.contextualize(run_id=run_id):
+                            df = reader.run()
+                    finally:
+                        logger.remove(handler_id)
+                        st.session_state["log_bytes"] = log_buffer.getvalue().encode("utf-8")
                     if df is not None:
-                        df.to_excel(excel_file_path, index=False)
+                        excel_buffer = BytesIO()
+                        df.to_excel(excel_buffer, index=False)
+                        st.session_state["excel_bytes"] = excel_buffer.getvalue()
+                    st.session_state["xml_bytes"] = reader.xml_bytes
                     st.session_state["process_done"] = True
 
-            if excel_file_path.exists():
-                with open(excel_file_path, "rb") as f:
-                    st.download_button(
-                        label="Download PDF Scan result as excel",
-                        data=f,
-                        file_name=excel_file_path.name,
-                        mime="application/vnd.ms-excel",
-                    )
+            if st.session_state.get("excel_bytes") is not None:
+                st.download_button(
+                    label="Download PDF Scan result as excel",
+                    data=st.session_state["excel_bytes"],
+                    file_name=f"{pdf_stem}.xlsx",
+                    mime="application/vnd.ms-excel",
+                )
                 st.success(f"PDF Scan result as excel, ready to be downloaded")
 
             # Provide download links for XML and log files
-            if xml_file_path.exists():
-                with open(xml_file_path, "rb") as f:
-                    st.download_button(
-                        label="Download XML",
-                        data=f,
-                        file_name=xml_file_path.name,
-                        mime="application/xml"
-                    )
+            if st.session_state.get("xml_bytes") is not None:
+                st.download_button(
+                    label="Download XML",
+                    data=st.session_state["xml_bytes"],
+                    file_name=f"{pdf_stem}.xml",
+                    mime="application/xml"
+                )
                 st.success(f"Successful created xml file, and validated with xsd validation")
             else:
                 if reader.if_xml:
                     st.error(f"Error while creating xml file")
 
-            if log_file_path.exists():
-                with open(log_file_path, "rb") as f:
-                    st.download_button(
-                        label="Download Log",
-                        data=f,
-                        file_name=f"{xml_file_path.stem}.log",
-                        mime="text/plain"
-                    )
+            if st.session_state.get("log_bytes") is not None:
+                st.download_button(
+                    label="Download Log",
+                    data=st.session_state["log_bytes"],
+                    file_name=f"{pdf_stem}.log",
+                    mime="text/plain"
+                )
                 st.warning(f"Please make sure, you download the log, and check if there are any warnings & errors")
             else:
                 st.error(f"Error while getting log file")
 
-            st.success("Processing complete, Please refresh page if you want process another PDF file!")
+            st.success("Processing complete, upload another PDF file to process it!")
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
             logger.exception("An error occurred during processing.")
 
 if __name__ == "__main__":
-        
-    # Set up paths
-    output_folder_path = Path("output")
-    output_folder_path.mkdir(parents=True, exist_ok=True)
-
-    log_folder_path = output_folder_path / "log"
-    log_folder_path.mkdir(parents=True, exist_ok=True)
-
-    main(output_folder_path, log_folder_path)
-
+    main()
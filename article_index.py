@@ -0,0 +1,121 @@
+from difflib import SequenceMatcher
+from typing import Iterable, List, Union
+import re
+import unicodedata
+
+import numpy as np
+
+LOT_PREFIX_PATTERN = re.compile(r'^(LOTS|LOT)\s+')
+
+
+def normalize_article_name(article_name:str) -> str:
+    """
+    Key of an article name, the same for its common variants: uppercase, without accents, whitespace collapsed,
+    without the LOT / LOTS prefix, words without their plural S, and any blazer is a VESTE.
+    """
+    folded = unicodedata.normalize("NFKD", article_name)
+    folded = "".join(char for char in folded if not unicodedata.combining(char))
+    key = " ".join(folded.upper().split())
+    key = LOT_PREFIX_PATTERN.sub("", key)
+    if "BLAZER" in key:
+        return "VESTE"
+    return " ".join(word[:-1] if len(word) > 3 and word.endswith("S") else word for word in key.split(" "))
+
+
+class CloseMatchIndex:
+    """
+    Same result as difflib.get_close_matches(word, articles, n=1, cutoff) without a SequenceMatcher ratio per catalog entry.
+    Built once on the character counts of the articles: the counts shared with the word give for all entries at once
+    the upper bound difflib checks before its ratio (quick_ratio), and the exact ratio is only computed on the few
+    best bounded candidates, until the bound falls under the best ratio found.
+    """
+
+    def __init__(self, articles:Iterable[str]) -> None:
+        self.articles = list(dict.fromkeys(a for a in articles if isinstance(a, str)))   # unique, in catalog order
+        alphabet = sorted({char for article in self.articles for char in article})
+        self._char_column = {char: i for i, char in enumerate(alphabet)}
+        self._counts = np.zeros((len(self.articles), len(alphabet)), dtype=np.int32)
+        for row, article in enumerate(self.articles):
+            for char in article:
+                self._counts[row, self._char_column[char]] += 1
+        self._lengths = np.array([len(a) for a in self.articles], dtype=np.float64)
+
+    def _quick_ratios(self, word:str) -> np.ndarray:
+        # difflib quick_ratio of every article against word: 2 * shared chars / total length
+        word_counts = np.zeros(len(self._char_column), dtype=np.int32)
+        for char in word:
+            if char in self._char_column:
+                word_counts[self._char_column[char]] += 1
+        shared = np.minimum(self._counts, word_counts).sum(axis=1)
+        total = self._lengths + len(word)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(total > 0, 2.0 * shared / total, 1.0)
+
+    def get_close_matches(self, word:str, cutoff:float = 0.6) -> List[str]:
+        if not self.articles:
+            return []
+        bounds = self._quick_ratios(word)
+        candidates = np.flatnonzero(bounds >= cutoff)
+        candidates = candidates[np.argsort(-bounds[candidates], kind="stable")]
+        matcher = SequenceMatcher()
+        matcher.set_seq2(word)  # same roles as difflib: article is seq1, word is seq2
+        best = None
+        for row in candidates:
+            if best is not None and bounds[row] < best[0]:
+                break   # no ratio above its bound, and ties go to the greater article like in difflib
+            article = self.articles[row]
+            matcher.set_seq1(article)
+            score = matcher.ratio()
+            if score >= cutoff and (best is None or (score, article) > best):
+                best = (score, article)
+        return [best[1]] if best else []
+
+
+class _TrieNode:
+    __slots__ = ("children", "row", "subtree_row")
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.row = None     # first catalog row of the article ending here
+        self.subtree_row = None     # first catalog row of the articles below, this one included
+
+
+class PrefixTrie:
+    """
+    Articles by characters, for the startswith fallback: the first article in catalog order that is a prefix of the name,
+    or that the name is a prefix of, found by walking the name once instead of testing every article.
+    """
+
+    def __init__(self, articles:Iterable[str]) -> None:
+        self.articles = []
+        self._root = _TrieNode()
+        for row, article in enumerate(articles):
+            self.articles.append(article)
+            if isinstance(article, str):
+                self._insert(article, row)
+
+    def _insert(self, article:str, row:int) -> None:
+        # rows come in increasing order, the first row of each node is kept
+        node = self._root
+        if node.subtree_row is None:
+            node.subtree_row = row
+        for char in article:
+            node = node.children.setdefault(char, _TrieNode())
+            if node.subtree_row is None:
+                node.subtree_row = row
+        if node.row is None:
+            node.row = row
+
+    def find(self, name:str) -> Union[str, None]:
+        rows = []
+        node = self._root
+        for char in name:
+            if node.row is not None:
+                rows.append(node.row)     # article that is a prefix of name
+            node = node.children.get(char)
+            if node is None:
+                break
+        else:
+            if node.subtree_row is not None:
+                rows.append(node.subtree_row)     # articles starting with name, name itself included
+        return self.articles[min(rows)] if rows else None
@@ -1,50 +1,257 @@
-
+from collections import Counter, OrderedDict
+from functools import cached_property
 from pathlib import Path
-from typing import Union
-import re
+from typing import Dict, Tuple, Union
+import os
+import pickle
+import threading
 
+import numpy as np
 import pandas as pd
-from difflib import get_close_matches
 from loguru import logger
 
+from article_index import CloseMatchIndex, PrefixTrie, normalize_article_name
+from extraction_cache import file_sha256
+
+SNAPSHOT_VERSION = 4     # bump when the snapshot content (sheets or indexes) changes
+CATALOG_SHEET = "ARTICLE+CODE+POIDS"
+CATALOG_COLUMNS = ["ARTICLE", "CODE", "POIDS/ARTICLE"]     # the only columns looked up
+
 
 class Article_Info:
-    def __init__(self, source_excel:Path) -> None:
-        self.df = pd.read_excel(source_excel, sheet_name="ARTICLE+CODE+POIDS")
-        self._df_habilite = pd.read_excel(source_excel, sheet_name="STE+NO HABILITE")
-
-    def _clean_article_name(self, article_name:str) -> str:
-        # Regular expression to remove 'LOTS ' or 'LOT ' at the beginning of the string
-        cleaned_string = re.sub(r'^(LOTS|LOT)\s+', '', article_name)
-        if 'blazer' in cleaned_string.lower():
-            cleaned_string = 'VESTE'
-        if cleaned_string != article_name:
-            logger.info(f"cleaned article_name from {article_name} to {cleaned_string}")
-        return cleaned_string
+    def __init__(self, source_excel:Path, memo_size:int = 4096, use_snapshot:bool = True) -> None:
+        self.source_excel = Path(source_excel)
+        self.memo_size = memo_size     # article names whose resolution is kept, least recently used dropped first
+        # sheets and indexes are read back from a snapshot next to the workbook, rebuilt when the workbook changes
+        self.use_snapshot = use_snapshot
+        self.snapshot_path = self.source_excel.with_name(f"{self.source_excel.name}.snapshot.pkl")
+        self._df = None     # catalog sheet, loaded on the first lookup
+        self._lock = threading.Lock()     # one instance can be shared by the threads of the streamlit sessions
+        self.reset_memo()
 
-    def get_article_info(self, article_name:str, target_col:str) -> Union[str, None]:
-        df = self.df
-        related_code = df.loc[df['ARTICLE'] == article_name, target_col].values
+    def __getstate__(self) -> Dict:
+        # pickled with the readers into the worker processes, without the lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state:Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            with self._lock:
+                if self._df is None:
+                    self._load_catalog()
+        return self._df
+
+    @cached_property
+    def _df_habilite(self) -> pd.DataFrame:
+        # not used by the lookups, only read when asked for
+        return pd.read_excel(self.source_excel, sheet_name="STE+NO HABILITE")
+
+    def _load_catalog(self) -> None:
+        if self.use_snapshot and self._load_snapshot():
+            return
+        self._df = self._read_catalog()
+        self._build_index()
+        if self.use_snapshot:
+            self._save_snapshot()
+
+    def _read_catalog(self) -> pd.DataFrame:
+        df = pd.read_excel(self.source_excel, sheet_name=CATALOG_SHEET, usecols=CATALOG_COLUMNS)
+        # CN8 codes fit in int32, POIDS/ARTICLE stays float64 for the same net masses,
+        # codes typed as text ("03019110", "6104 33 00") are kept as they are
+        if pd.api.types.is_integer_dtype(df["CODE"]):
+            df["CODE"] = pd.to_numeric(df["CODE"], downcast="integer")
+        return df
+
+    def _snapshot_state(self) -> Dict:
+        return {
+            "_df": self._df,
+            "_row_of_article": self._row_of_article,
+            "_row_of_key": self._row_of_key,
+            "_close_match_index": self._close_match_index,
+            "_prefix_trie": self._prefix_trie,
+        }
+
+    def _get_snapshot_key(self) -> Dict:
+        stat = self.source_excel.stat()
+        return {"version": SNAPSHOT_VERSION, "pandas": pd.__version__, "mtime": stat.st_mtime, "size": stat.st_size}
+
+    def _load_snapshot(self) -> bool:
+        if not self.snapshot_path.exists():
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"can't read the snapshot {self.snapshot_path}, reading the workbook: {e}")
+            return False
+        key = self._get_snapshot_key()
+        if {k: snapshot["key"].get(k) for k in ("version", "pandas")} != {k: key[k] for k in ("version", "pandas")}:
+            return False
+        if (snapshot["key"]["mtime"], snapshot["key"]["size"]) != (key["mtime"], key["size"]):
+            # touched workbook, still the same when its content is
+            if snapshot["sha256"] != file_sha256(self.source_excel):
+                logger.info(f"{self.source_excel.name} changed, rebuilding its snapshot")
+                return False
+            snapshot["key"] = key
+            self._write_snapshot(snapshot)
+        self.__dict__.update(snapshot["state"])
+        logger.debug(f"loaded {self.source_excel.name} from its snapshot {self.snapshot_path}")
+        return True
+
+    def _save_snapshot(self) -> None:
+        self._write_snapshot({"key": self._get_snapshot_key(), "sha256": file_sha256(self.source_excel), "state": self._snapshot_state()})
+
+    def _write_snapshot(self, snapshot:Dict) -> None:
+        # written aside then renamed, a concurrent reader never sees half a snapshot
+        temp_path = self.snapshot_path.with_name(f"{self.snapshot_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"can't write the snapshot {self.snapshot_path}: {e}")
+
+    def _build_index(self) -> None:
+        # ARTICLE: row position of its first row, built once, exact lookups don't scan the catalog
+        self._row_of_article = {}
+        for position, article in enumerate(self.df['ARTICLE']):
+            if isinstance(article, str):
+                self._row_of_article.setdefault(article, position)
+        # normalized key: row position of the first article with that key, for the variants of the names
+        self._row_of_key = {}
+        for article, position in self._row_of_article.items():
+            self._row_of_key.setdefault(normalize_article_name(article), position)
+        self._close_match_index = CloseMatchIndex(self.df['ARTICLE'])
+        self._prefix_trie = PrefixTrie(self.df['ARTICLE'])
+        self.reset_memo()
+
+    def reset_memo(self) -> None:
+        # the memoized resolutions point at catalog rows, reset when the catalog is loaded again
+        self._memo = OrderedDict()
+        self.stats = Counter()     # exact, normalized, fuzzy, prefix, failed resolutions, and memo_hits among them
 
+    def _get_row(self, article:str) -> Dict:
+        return self._get_row_at(self._row_of_article[article])
 
-        if related_code.size > 0:
-            logger.debug(f"The {target_col} for {article_name} is {related_code[0]}")
-            return related_code[0]
+    def _get_row_at(self, position:int) -> Dict:
+        return {col: self._df[col].values[position] for col in self._df.columns}
+
+    def _resolve(self, article_name:str) -> Tuple[str, Union[Dict, None]]:
+        if article_name in self._row_of_article:
+            return "exact", self._get_row(article_name)
+        key = normalize_article_name(article_name)
+        if key in self._row_of_key:
+            return "normalized", self._get_row_at(self._row_of_key[key])
+        # Find the closest match
+        closest_match = self._close_match_index.get_close_matches(article_name, cutoff=0.6)
+        if closest_match:
+            return "fuzzy", self._get_row(closest_match[0])
+        # First article that starts the name or is started by it
+        possible_match = self._prefix_trie.find(article_name)
+        if possible_match is not None:
+            return "prefix", self._get_row(possible_match)
+        return "failed", None
+
+    def resolve(self, article_name:str) -> Tuple[str, Union[Dict, None]]:
+        """
+        How article_name was resolved (exact, normalized, fuzzy, prefix or failed) and its catalog row (ARTICLE, CODE, POIDS/ARTICLE):
+        exact match, else same normalized key (case, accents, LOT prefix, plural, ...), else the closest ARTICLE (difflib, cutoff 0.6),
+        else an ARTICLE starting the name or started by it.
+        Memoized on the raw article name, the same misspelled description is only matched once.
+        """
+        self.df     # loaded
+        with self._lock:
+            memoized = self._memo.get(article_name)
+            if memoized is not None:
+                self._memo.move_to_end(article_name)
+                self.stats["memo_hits"] += 1
+        if memoized is None:
+            memoized = self._resolve(article_name)     # outside the lock, the fuzzy match is the slow part
+        with self._lock:
+            self._memo[article_name] = memoized
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+            self.stats[memoized[0]] += 1
+        return memoized
+
+    def lookup(self, article_name:str) -> Union[Dict, None]:
+        # catalog row of article_name, None when not resolved
+        return self.resolve(article_name)[1]
+
+    def get_article_info(self, article_name:str, target_col:str) -> Union[str, None]:
+        method, row = self.resolve(article_name)
+        if row is None:
+            logger.error(f"No close matches found for '{article_name}'")
+            return None
+        if method == "exact":
+            logger.debug(f"The {target_col} for {article_name} is {row[target_col]}")
         else:
-            # Find the closest match
-            closest_match = get_close_matches(article_name, df['ARTICLE'], n=1, cutoff=0.6)
-            if closest_match:
-                closest_article = closest_match[0]
-                closest_code = df.loc[df['ARTICLE'] == closest_article, target_col].values[0]
-                logger.info(f"No exact match found for '{article_name}'. Closest match: '{closest_article}' with {target_col}='{closest_code}'")
-                return closest_code
-            else:
-                for possible_match in df['ARTICLE']:
-                    if article_name.startswith(possible_match) or possible_match.startswith(article_name):
-                        closest_code = df.loc[df['ARTICLE'] == possible_match, target_col].values[0]
-                        logger.info(f"No exact match found for '{article_name}'. Closest match: '{possible_match}' with {target_col}='{closest_code}'")
-                        return closest_code
+            logger.info(f"No exact match found for '{article_name}'. Closest match: '{row['ARTICLE']}' with {target_col}='{row[target_col]}'")
+        return row[target_col]
+
+    def resolve_many(self, article_names:pd.Series, target_cols:Tuple[str, ...] = ('CODE', 'POIDS/ARTICLE')) -> pd.DataFrame:
+        """
+        target_cols of each article name, aligned with article_names (same index, same order), None when not resolved.
+        Each distinct name is resolved once, invoices repeat the same articles on every page.
+        """
+        names, distinct_names = pd.factorize(article_names)     # code of each name in distinct_names, -1 for missing names
+        columns = {col: np.empty(len(distinct_names) + 1, dtype=object) for col in target_cols}     # last slot for the missing names
+        for position, article_name in enumerate(distinct_names):
+            method, row = self.resolve(article_name)
+            if row is None:
                 logger.error(f"No close matches found for '{article_name}'")
+            elif method != "exact":
+                logger.info(f"No exact match found for '{article_name}'. Closest match: '{row['ARTICLE']}' with " + ", ".join(f"{col}='{row[col]}'" for col in target_cols))
+            for col in target_cols:
+                columns[col][position] = None if row is None else row[col]
+        return pd.DataFrame({col: values[names] for col, values in columns.items()}, index=article_names.index)
+
+
+class SharedCatalog:
+    """
+    One Article_Info per workbook for the whole process, shared by all the streamlit sessions and reruns.
+    When the workbook mtime changes, the new catalog is loaded aside then swapped in: meanwhile, and after,
+    the sessions keep reading a complete catalog, the previous one until the swap.
+    """
+
+    def __init__(self) -> None:
+        self._catalogs = {}     # resolved workbook path: (mtime, Article_Info)
+        self._reload_lock = threading.Lock()
+
+    def get(self, source_excel:Path) -> Article_Info:
+        path = Path(source_excel).resolve()
+        mtime = path.stat().st_mtime
+        entry = self._catalogs.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        # the first caller loads, the others keep the previous catalog if there is one, else wait for it
+        if not self._reload_lock.acquire(blocking=entry is None):
+            return entry[1]
+        try:
+            entry = self._catalogs.get(path)
+            if entry is None or entry[0] != mtime:
+                catalog = Article_Info(source_excel=path)
+                catalog.df     # loaded before it is visible
+                logger.info(f"loaded catalog {path.name}, mtime {mtime}")
+                entry = (mtime, catalog)
+                self._catalogs[path] = entry     # swap, a single assignment
+            return entry[1]
+        finally:
+            self._reload_lock.release()
+
+
+shared_catalog = SharedCatalog()
+
+
+def get_shared_article_info(source_excel:Path) -> Article_Info:
+    return shared_catalog.get(source_excel)
+
 
 if __name__ == "__main__":
     source_excel = Path(r"data/DONNEES DOUANE PYTHON.xlsx")
@@ -0,0 +1,68 @@
+"""
+Fuzzy article matching, difflib.get_close_matches against CloseMatchIndex, on catalogs of growing size.
+Catalogs are the articles of the customs Excel plus random variants of them, queries are misspelled articles.
+The results are checked identical before the timings are printed.
+
+    python benchmark_article_matching.py [catalog sizes...]
+"""
+from difflib import get_close_matches
+from pathlib import Path
+import random
+import string
+import sys
+import time
+
+import pandas as pd
+
+from article_index import CloseMatchIndex
+
+
+def misspell(article:str, rng:random.Random) -> str:
+    chars = list(article)
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randrange(len(chars) + 1)
+        operation = rng.choice(["insert", "delete", "replace"])
+        if operation == "insert" or not chars:
+            chars.insert(position, rng.choice(string.ascii_uppercase + " "))
+        elif operation == "delete":
+            del chars[min(position, len(chars) - 1)]
+        else:
+            chars[min(position, len(chars) - 1)] = rng.choice(string.ascii_uppercase)
+    return "".join(chars)
+
+
+def make_catalog(articles:list, size:int, rng:random.Random) -> list:
+    catalog = list(articles)
+    while len(catalog) < size:
+        catalog.append(f"{rng.choice(articles)} {''.join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 8)))}")
+    return catalog[:size]
+
+
+def main(sizes:list) -> None:
+    rng = random.Random(0)
+    articles = pd.read_excel(Path("data/DONNEES DOUANE PYTHON.xlsx"), sheet_name="ARTICLE+CODE+POIDS")["ARTICLE"].dropna().tolist()
+    queries = [misspell(rng.choice(articles), rng) for _ in range(200)]
+    print(f"{'catalog':>8} {'difflib (ms/query)':>20} {'index (ms/query)':>18} {'build (ms)':>11} {'speed-up':>9}")
+    for size in sizes:
+        catalog = make_catalog(articles, size, rng)
+
+        start = time.perf_counter()
+        index = CloseMatchIndex(catalog)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = [get_close_matches(query, catalog, n=1, cutoff=0.6) for query in queries]
+        difflib_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        found = [index.get_close_matches(query, cutoff=0.6) for query in queries]
+        index_time = (time.perf_counter() - start) / len(queries)
+
+        mismatches = [(q, e, f) for q, e, f in zip(queries, expected, found) if e != f]
+        if mismatches:
+            raise AssertionError(f"{len(mismatches)} results differ from difflib on {size} articles, first: {mismatches[0]}")
+        print(f"{size:>8} {difflib_time * 1000:>20.3f} {index_time * 1000:>18.3f} {build * 1000:>11.1f} {difflib_time / index_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [49, 500, 2000, 10000])
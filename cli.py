@@ -1,17 +1,23 @@
 from pathlib import Path
 import sys
 import argparse
+import multiprocessing
+from typing import List, Union
 
 import pandas as pd
 from loguru import logger
 
 from article_info import Article_Info
+from extraction_cache import ExtractionCache
 from ivivi_facture_reader import IviviFactureReader
 from jessy_facture_reader import JessyFactureReader
 from dolvika_facture_reader import DolvikaFactureReader
 from mod_facture_reader import ModFactureReader
 from sarl_zhc_facture_reader import SarlZhcFactureReader
 from zhc_facture_reader import ZhcFactureReader
+from dl_chic_facture_reader import DlChicFactureReader
+from reader_fingerprint import detect_company
+from page_pool import get_previous_pages_to_double_check
 
 
 func_mapping = {
@@ -21,14 +27,35 @@ func_mapping = {
     "MODE_CMD": ModFactureReader,
     "SARL_ZHC": SarlZhcFactureReader,
     "ZHC": ZhcFactureReader,
+    "DL_CHIC": DlChicFactureReader,
 }
 
-def detect_company_from_folder(path: Path) -> str:
+def detect_company_from_folder(path: Path) -> Union[str, None]:
+    # None when the folder name has no company name, the company of each pdf is then detected from its first page
     folder_name = path.name.upper()
     for company_name in func_mapping.keys():
         if company_name in folder_name:
             return company_name
-    raise ValueError(f"Company name not detected in folder: {folder_name}, supported companies: {', '.join(func_mapping.keys())}")
+
+
+def parse_page_numbers(pages: str) -> Union[List[int], str]:
+    # --pages type: "3,5,10-12" -> [3, 5, 10, 11, 12], "double-check" is kept as is
+    if pages == "double-check":
+        return pages
+    page_numbers = []
+    for part in pages.split(","):
+        try:
+            if "-" in part:
+                start, end = part.split("-")
+                page_range = range(int(start), int(end) + 1)
+            else:
+                page_range = range(int(part), int(part) + 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid page or page range {part!r} in {pages!r}, expected e.g. 3,5,10-12 or double-check")
+        if not page_range or page_range.start < 1:
+            raise argparse.ArgumentTypeError(f"invalid page range {part!r} in {pages!r}, pages start at 1 and ranges go up")
+        page_numbers += page_range
+    return page_numbers
 
 
 def main():
@@ -39,7 +66,43 @@ def main():
         default=Path.cwd(),
         help="Working folder containing input/output folders and Excel file (default: current folder)"
     )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to extract pages of each PDF in parallel (default: 1, sequential)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Extract all pages again, instead of reusing the extraction of a previous run on the same PDF (output/cache)"
+    )
+    parser.add_argument(
+        "--pages",
+        type=parse_page_numbers,
+        default=None,
+        help="Only extract again these pages (e.g. 3,5,10-12), or 'double-check' for the pages to double check of the previous run, "
+             "and merge them into the previous extraction of each PDF"
+    )
+    parser.add_argument(
+        "--strategy",
+        type=str,
+        default=None,
+        choices=sorted({strategy for reader_class in func_mapping.values() for strategy in reader_class.retry_strategies}),
+        help="Alternate extraction for the pages given by --pages (flip_mode: other description mode for JESSY/MODE_CMD, next_page_remise: IVIVI)"
+    )
+    parser.add_argument(
+        "--page-timeout",
+        type=float,
+        default=None,
+        help="Give up the pages taking more than this many seconds to extract, they are listed in the pages to double check"
+    )
     args = parser.parse_args()
+    if args.pages and args.no_cache:
+        parser.error("--pages merges into the previous extraction, it can't be used with --no-cache")
+    if args.strategy and not args.pages:
+        parser.error("--strategy only applies to the pages extracted again, it needs --pages")
+    page_numbers = args.pages if args.pages and args.pages != "double-check" else None
     working_dir = args.path.resolve()
     input_path = working_dir
     output_path = working_dir / "output"
@@ -53,10 +116,8 @@ def main():
     # Detect company
     company_name = detect_company_from_folder(working_dir)
     if not company_name:
-        print(f"❌ Cannot detect company name from folder: {working_dir.name}")
+        print(f"ℹ️ No company name in folder: {working_dir.name}, detecting the company of each PDF from its first page")
         print(f"Supported companies: {', '.join(func_mapping.keys())}")
-        input("Press Enter to exit...")
-        sys.exit(1)
 
     # Load article info
     if not excel_path.exists():
@@ -65,7 +126,7 @@ def main():
         sys.exit(1)
 
     article_info = Article_Info(source_excel=excel_path)
-    reader_class = func_mapping[company_name]
+    extraction_cache = None if args.no_cache else ExtractionCache(db_path=output_path / "cache" / "extraction.sqlite")
 
     # Process PDFs
     pdf_files = list(input_path.glob("*.pdf"))
@@ -81,15 +142,30 @@ def main():
         logger.add(log_file_path, level="DEBUG")
 
         try:
+            pdf_company_name = company_name or detect_company(pdf_path=pdf_file, func_mapping=func_mapping, extraction_cache=extraction_cache)
+            reader_class = func_mapping[pdf_company_name]
+            if args.strategy and args.strategy not in reader_class.retry_strategies:
+                raise ValueError(f"strategy {args.strategy} not available for {pdf_company_name}, available: {reader_class.retry_strategies}")
             reader = reader_class(
                 pdf_path=pdf_file,
                 article_info=article_info,
                 output_folder_path=output_path,
+                workers=args.workers,
+                extraction_cache=extraction_cache,
+                page_numbers=page_numbers,
+                strategy=args.strategy,
+                page_time_budget=args.page_timeout,
             )
+            if args.pages == "double-check":
+                reader.page_numbers = get_previous_pages_to_double_check(reader=reader)
+                if not reader.page_numbers:
+                    print(f"✅ Nothing to double check: {pdf_file.name}")
+                    continue
             df = reader.run()
+            logger.info(f"article resolutions since start: {dict(article_info.stats)}")
             if isinstance(df, pd.DataFrame):
                 df.to_excel(output_path / f"{pdf_file.stem}.xlsx", index=False)
-            print(f"✅ Processed: {pdf_file.name}")
+            print(f"✅ Processed: {pdf_file.name} ({pdf_company_name})")
         except Exception as e:
             logger.error(f"Failed to process {pdf_file.name}: {e}")
             print(f"❌ Error processing {pdf_file.name}: {e}")
@@ -99,4 +175,5 @@ def main():
     input("✔️ Finished processing. Press Enter to exit...")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()    # needed by the worker processes in the pyinstaller exe
     main()
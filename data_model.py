@@ -85,9 +85,10 @@ class Envelope(BaseModel):
 class Instat(BaseModel):
     Envelope: Envelope
 
-    def export_to_xml(self, output_xml_path: Path, party_tag: str, root_tag: str = "INSTAT"):
+    def export_to_xml(self, output_xml_path: Union[Path, None], party_tag: str, root_tag: str = "INSTAT") -> bytes:
         """
-        Export the Pydantic model instance to an XML file.
+        Export the Pydantic model instance to XML, built in memory.
+        Also written to output_xml_path, unless it is None.
         """
         def dict_to_xml(tag, d):
             """
@@ -116,37 +117,30 @@ class Instat(BaseModel):
         # Create the root element of XML
         root = dict_to_xml(root_tag, data_dict)
 
-        # Create the XML tree and write to file
-        tree = ET.ElementTree(root)
-        logger.info(f"writing xml file to {output_xml_path}")
-        tree.write(output_xml_path, encoding="utf-8", xml_declaration=True)
+        # Serialize the XML tree, and put the party tag in place
+        xml_bytes = ET.tostring(root, encoding="utf-8", xml_declaration=True)
+        xml_bytes = xml_bytes.replace(b"<Party>", party_tag.encode("utf-8"))
 
-        self.replace_string_in_file(file_path=output_xml_path, old_string="<Party>", new_string=party_tag)
+        if output_xml_path is not None:
+            logger.info(f"writing xml file to {output_xml_path}")
+            Path(output_xml_path).write_bytes(xml_bytes)
+        return xml_bytes
 
-    def replace_string_in_file(self, file_path: Path, old_string: str, new_string: str):
-        # Read the file's content
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-
-        # Replace the old string with the new string
-        modified_content = content.replace(old_string, new_string)
-
-        # Write the modified content back to the file
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(modified_content)
-
-    def validate_xml(self, xml_file:Path):
+    def validate_xml(self, xml_file:Union[Path, bytes]):
         xsd_file=self.resource_path("xsd_valide.xsd")
         # Parse the XSD schema file
         with open(xsd_file, 'r') as schema_file:
             schema_root = etree.parse(schema_file)
             xmlschema = etree.XMLSchema(schema_root)
 
-        # Parse the XML file
-        with open(xml_file, 'r') as xml_file:
-            xml_root = etree.parse(xml_file)
+        # Parse the XML, file or in-memory bytes
+        if isinstance(xml_file, bytes):
+            xml_root = etree.fromstring(xml_file)
+        else:
+            with open(xml_file, 'r') as xml_file:
+                xml_root = etree.parse(xml_file)
 
-        # Validate the XML file against the XSD schema
+        # Validate the XML against the XSD schema
         is_valid = xmlschema.validate(xml_root)
 
         if is_valid:
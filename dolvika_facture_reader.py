@@ -1,10 +1,9 @@
 
 from pathlib import Path
-from typing import List, Union, Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple, Union
 import re
 from datetime import datetime
 
-import pdfplumber
 from loguru import logger
 import pandas as pd
 import numpy as np
@@ -12,6 +11,12 @@ import pycountry
 
 from data_model import Party, Item_unit, Declaration_unit, CN8, Envelope, DateTime, Function, Instat
 from article_info import Article_Info
+from page_pool import PageResult, iter_page_dfs
+from extraction_cache import ExtractionCache
+from extraction_backend import as_pdf_source, get_pdf_name
+from page_layout import PageLayout
+from number_parser import parse_french_numbers
+from invoice_state import InvoicePage, InvoiceState
 
 
 class DolvikaFactureReader:
@@ -24,17 +29,35 @@ class DolvikaFactureReader:
     envelopeId = "S4FW"
     declarationTypeCode = 1     # 1 or 4 depends on company,
     if_xml: bool = True
+    page_keywords = []     # no item table header is matched on the pages, they are kept on their Numéro / Date line instead, see _get_skip_reason
+    layout_version = 4     # bump when the page extraction changes, to invalidate the extraction cache
+    extraction_backend = "text"     # only text lines are matched, pages are read without rects, lines and curves
+    retry_strategies = []     # alternate ways to extract a page, for the pages to double check
+    page_time_budget = None     # seconds, pages taking longer are given up and double checked, None for no limit
+    patterns = {     # compiled once per class, the page and item loops only use these
+        "number_date": re.compile(r"(.+?)\s(\d{2}/\d{2}/\d{4})"),
+        "number_date_cee": re.compile(r"(.+?)\s(\d{2}/\d{2}/\d{4}).*\s+CEE\s+(.+)"),
+        "item_line": re.compile(r"(^\d*|BB|PSE|PRE50)\s+([\w\s']+)(\s+\d+,\d{2})+\s+(\d+\s?\d*,\d{2})(\s[1])?$"),
+    }
 
-    def __init__(self, pdf_path:Path, article_info: Article_Info, output_folder_path:Path) -> None:
-        self.pdf_path = pdf_path
+    def __init__(self, pdf_path:Union[Path, bytes, BinaryIO], article_info: Article_Info, output_folder_path:Union[Path, None], workers:int = 1, extraction_cache:ExtractionCache = None, page_numbers:List[int] = None, strategy:str = None, page_time_budget:float = None, pdf_name:str = None) -> None:
+        self.pdf_path = as_pdf_source(pdf_path)     # path, or stream for a pdf kept in memory
+        self.pdf_name = pdf_name or get_pdf_name(self.pdf_path)
         self.article_info = article_info
-        self.output_xml_path = output_folder_path / f"{self.pdf_path.stem}.xml"
+        self.output_xml_path = output_folder_path / f"{Path(self.pdf_name).stem}.xml" if output_folder_path is not None else None     # None to keep the xml in memory only
+        self.xml_bytes = None
         self._previous_page_metadata = {}
         self._pages_to_double_check = []
+        self._page_reasons = {}    # page_number: reason, for pages skipped before extraction or given up
         self.df_item_all = None
+        self.workers = workers     # > 1 to extract pages in parallel worker processes
+        self.extraction_cache = extraction_cache     # reuse the page extraction of a previous run on the same pdf
+        self.page_numbers = page_numbers     # only extract again these pages, merged into the previous extraction in the cache
+        self.strategy = strategy     # one of retry_strategies, to extract again the pages to double check differently
+        if page_time_budget is not None:
+            self.page_time_budget = page_time_budget
         self.HEIGHT = 841.92004
         self.WIDTH = 595.32001
-        self.metadata_all = {}
 
     @property
     def pages_to_double_check(self) -> List:
@@ -43,33 +66,32 @@ class DolvikaFactureReader:
     def run(self) -> Union[pd.DataFrame, None]:
         instat = self.get_instat()
         df_envelope = instat.Envelope.to_df()   # not always match with df_item_all, because df_item could have item doesn't match code in data\DONNEES DOUANE PYTHON.xlsx
-        instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
+        self.xml_bytes = instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
         logger.warning(f"All page_numbers (skipped) to double check : {self._pages_to_double_check}")
-        instat.validate_xml(xml_file=self.output_xml_path)
+        if self._page_reasons:
+            logger.warning(f"Reasons of the skipped pages : {self._page_reasons}")
+        instat.validate_xml(xml_file=self.xml_bytes)
         if self.df_item_all is not None:
             return self.df_item_all
 
-    def _get_number_date_info(self, page) -> Dict:
+    def _get_number_date_info(self, layout:PageLayout) -> Dict:
 
         BOUNDING_BOX_1 = (0, self.HEIGHT * 0.30, self.WIDTH , self.HEIGHT * 0.34) 
-        res = self._cut_for_number_date(page, BOUNDING_BOX_1)
+        res = self._cut_for_number_date(layout, BOUNDING_BOX_1)
         if res:
             return res
         else:
             BOUNDING_BOX_2 = (0, self.HEIGHT * 0.25, self.WIDTH , self.HEIGHT * 0.30) 
-            res = self._cut_for_number_date(page, BOUNDING_BOX_2)
+            res = self._cut_for_number_date(layout, BOUNDING_BOX_2)
             if res:
                 return res
             else:
                 raise ValueError(f"Can't get numero & date")
     
-    def _cut_for_number_date(self, page, box):
-        corp_1 = page.crop(box)
-        lines = corp_1.extract_text_lines()
-        pattern = r"(.+?)\s(\d{2}/\d{2}/\d{4})"
-        pattern_2 = pattern + r".*\s+CEE\s+(.+)"
+    def _cut_for_number_date(self, layout:PageLayout, box):
+        lines = layout.lines_in(box)
         for line in lines:
-            match = re.search(pattern, line["text"])
+            match = self.patterns["number_date"].search(line["text"])
             if match:
                 facture_number = match.group(1).replace(" ", "")
                 Date = match.group(2)
@@ -77,7 +99,7 @@ class DolvikaFactureReader:
                     "Numéro": facture_number,
                     "Date": Date,
                 }
-                match_2 = re.search(pattern_2, line["text"])
+                match_2 = self.patterns["number_date_cee"].search(line["text"])
                 if match_2:
                     corp_1_dict["CEE"] = match_2.group(3)
                 else:
@@ -92,10 +114,9 @@ class DolvikaFactureReader:
             return any(country.name.lower() == name.lower() for country in pycountry.countries)
         return any(_is_country(x) for x in names)
 
-    def _get_address_dict(self, page) -> Dict:
+    def _get_address_dict(self, layout:PageLayout) -> Dict:
         BOUNDING_BOX = (self.WIDTH/2, self.HEIGHT * 0.10, self.WIDTH , self.HEIGHT * 0.28) 
-        corp_1 = page.crop(BOUNDING_BOX)
-        lines = corp_1.extract_text_lines()
+        lines = layout.lines_in(BOUNDING_BOX)
         country = None
         tva_number = None
         for x in lines:
@@ -106,70 +127,109 @@ class DolvikaFactureReader:
         return {"dest_country": country, "N° TVA": tva_number}
 
     def get_instat(self) -> Instat:
-        with pdfplumber.open(self.pdf_path) as pdf:
-            dfs = []
-            for page_index, page in enumerate(pdf.pages):
-                text = page.extract_text_simple()
-                if page.page_number == 1:
-                    # just to double check if the pdf is matched with party name
-                    if self.party.partyName not in text:
-                        raise ValueError(f"{self.party.partyName} not found in {self.pdf_path}, page: {page.page_number}, probably wrong input pdf")
-                try:
-                    logger.info(f"extracting information from page number: {page.page_number}")
-                    df_item = self._get_full_df_from_page(page=page)
-                    print(df_item)
-                    if not df_item.empty:
-                        # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
-                        is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
-                        # check if dest_country is FR(France) or not using starts with "FR" or "GB"
-                        is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("ROYAUME").any()
-                        logger.debug(f"Checked is_good_tva: {is_good_tva}")
-                        if is_good_tva and not is_to_fr_or_gb:
-                            dfs.append(df_item)
-                        else:
-                            logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page.page_number}")
-                            self._pages_to_double_check.append(page.page_number)
-                    else:
-                        self._pages_to_double_check.append(page.page_number)
-                except Exception as e:
-                    logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
-                    self._pages_to_double_check.append(page.page_number)
-                    continue
-            df = pd.concat(dfs, axis=0)
-            self.df_item_all = df.copy()
-            envelope = self._get_envelope(df=df)
-            instat = Instat(Envelope=envelope)
-            return instat
+        dfs = iter_page_dfs(reader=self)
+        df = pd.concat(dfs, axis=0)
+        self.df_item_all = df.copy()
+        envelope = self._get_envelope(df=df)
+        instat = Instat(Envelope=envelope)
+        return instat
+
+    def _get_skip_reason(self, text:str) -> Union[str, None]:
+        # cheap check on the page text before the crops, pages without the Numéro / Date line _get_invoice_page needs
+        # (terms and conditions, blank versos, ...) can't be read
+        if not self.patterns["number_date"].search(text):
+            return "no Numéro / Date line found"
 
-    def _set_or_get_metadata_dict_from_self(self, metadata_dict:Dict) -> Dict:
-        if not self.metadata_all.get(metadata_dict["Numéro"]):
-            # if first time see the Numéro, add it into self
-            self.metadata_all[metadata_dict["Numéro"]] = metadata_dict
-        return self.metadata_all[metadata_dict["Numéro"]]
+    def _iter_page_results(self, pdf, page_indices) -> Iterator[Tuple[int, Union[InvoicePage, None]]]:
+        # (page_number, InvoicePage or None when skipped) for every page, the pages don't depend on each other, _reduce_invoice_pages does
+        for page_index in page_indices:
+            page = pdf.pages[page_index]
+            layout = PageLayout(page)
+            text = layout.text()
+            if page.page_number == 1:
+                # just to double check if the pdf is matched with party name
+                if self.party.partyName not in text:
+                    raise ValueError(f"{self.party.partyName} not found in {self.pdf_name}, page: {page.page_number}, probably wrong input pdf")
+            skip_reason = self._get_skip_reason(text)
+            if skip_reason:
+                logger.info(f"skipped page number: {page.page_number}, {skip_reason}")
+                self._pages_to_double_check.append(page.page_number)
+                self._page_reasons[page.page_number] = skip_reason
+                page.close()
+                yield page.page_number, None
+                continue
+            logger.info(f"extracting information from page number: {page.page_number}")
+            invoice_page = self._get_invoice_page(layout=layout)
+            page.close()     # release the cached page objects, so memory doesn't grow with the number of pages
+            yield page.page_number, invoice_page
 
-    def _get_full_df_from_page(self, page) -> pd.DataFrame:
+    def _reduce_invoice_pages(self, page_results:Iterable[PageResult]) -> Iterator[PageResult]:
+        # ordered pass over the extracted pages: all the pages of a Numéro use the first header seen for it, then the page items are checked
+        invoices = InvoiceState()
+        for page_result in page_results:
+            invoice_page = page_result.invoice_page
+            if invoice_page is None:
+                yield page_result   # skipped page
+                continue
+            page_number = page_result.page_number
+            pages_to_double_check = list(page_result.pages_to_double_check)
+            page_df = None
+            try:
+                if invoice_page.header is None:
+                    raise ValueError(invoice_page.error)
+                metadata_dict = invoices.open(invoice_page.invoice_number, dict(invoice_page.header))
+                metadata_dict["page_number"] = page_number
+                logger.debug(f"Got metadata_dict: {metadata_dict}")
+                if invoice_page.error:
+                    raise ValueError(invoice_page.error)
+                df_item = invoice_page.df
+                for k, v in metadata_dict.items():  # add metadata dict into df_items
+                    df_item[k] = v
+                print(df_item)
+                if not df_item.empty:
+                    # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
+                    is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
+                    # check if dest_country is FR(France) or not using starts with "FR" or "GB"
+                    is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("ROYAUME").any()
+                    logger.debug(f"Checked is_good_tva: {is_good_tva}")
+                    if is_good_tva and not is_to_fr_or_gb:
+                        page_df = df_item
+                    else:
+                        logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page_number}")
+                        pages_to_double_check.append(page_number)
+                else:
+                    pages_to_double_check.append(page_number)
+            except Exception as e:
+                logger.error(f"Error while processing page : {page_number}, skipped, error: {e}")
+                pages_to_double_check.append(page_number)
+            yield page_result._replace(df=page_df, pages_to_double_check=pages_to_double_check, invoice_page=None)
 
-        metadata_dict = self._get_number_date_info(page)
-        address_dict = self._get_address_dict(page)
-        metadata_dict = {**metadata_dict, **address_dict}
-        metadata_dict = self._set_or_get_metadata_dict_from_self(metadata_dict)
-        metadata_dict["page_number"] = page.page_number
-        logger.debug(f"Got metadata_dict: {metadata_dict}")
+    def _get_invoice_page(self, layout:PageLayout) -> InvoicePage:
+        # header and items of the page on its own, errors are kept for _reduce_invoice_pages
+        try:
+            metadata_dict = self._get_number_date_info(layout)
+            address_dict = self._get_address_dict(layout)
+            metadata_dict = {**metadata_dict, **address_dict}
+            invoice_number = metadata_dict["Numéro"]
+        except Exception as e:
+            return InvoicePage(invoice_number=None, is_first_page=True, header=None, fields={}, df=None, error=str(e))
+        try:
+            df_item = self._get_page_item_df(layout)
+        except Exception as e:
+            return InvoicePage(invoice_number=invoice_number, is_first_page=True, header=metadata_dict, fields={}, df=None, error=str(e))
+        return InvoicePage(invoice_number=invoice_number, is_first_page=True, header=metadata_dict, fields={}, df=df_item, error=None)
+
+    def _get_page_item_df(self, layout:PageLayout) -> pd.DataFrame:
         BOUNDING_BOX = (0, self.HEIGHT * 0.38, self.WIDTH , self.HEIGHT) 
-        corp_1 = page.crop(BOUNDING_BOX)
-        lines = corp_1.extract_text_lines()
-        pattern = r"(^\d*|BB|PSE|PRE50)\s+([\w\s']+)(\s+\d+,\d{2})+\s+(\d+\s?\d*,\d{2})(\s[1])?$"
+        lines = layout.lines_in(BOUNDING_BOX)
         line_texts = []
         for x in lines:
-            match = re.search(pattern, x["text"])
+            match = self.patterns["item_line"].search(x["text"])
             if match:
                 line_texts.append(x["text"].replace(match.group(2), match.group(2).replace(" ", "")).replace(match.group(4), match.group(4).replace(" ", "")))
         print(line_texts)
                 
-        df_item = self._get_item_df(line_texts)
-        for k, v in metadata_dict.items():  # add metadata dict into df_items
-            df_item[k] = v
-        return df_item
+        return self._get_item_df(line_texts)
 
     def _get_item_df(self, raw_data: List) -> pd.DataFrame:
         item_to_match = ["Code article", "Désignation", "Quantité", "P.U. HT", "Rem. %", "Montant HT", "TVA"]
@@ -184,11 +244,8 @@ class DolvikaFactureReader:
                 raise ValueError(f"Missing column data during df_item preparison")
             df_data.append(splited_text.copy())
         df = pd.DataFrame.from_records(df_data, columns=item_to_match)
-        numeric_columns = ["Quantité", "P.U. HT", "Montant HT"]
-        for col in numeric_columns:
-            df[col] = df[col].str.replace(',', '.')
-            df[col] = df[col].str.replace(' ', '')
-            df[col] = df[col].astype(float)
+        numeric_columns = ["Quantité", "P.U. HT", "Rem. %", "Montant HT"]
+        df = parse_french_numbers(df, numeric_columns)
         # round Montant HT
         df['Montant HT'] = df['Montant HT'].round()
         return df
@@ -212,14 +269,13 @@ class DolvikaFactureReader:
         output_list = []
         for index, data in df.iterrows():
             item_number = index + 1
-            article_name=data["Désignation"]
-            cn8 = self._get_cn8(article_name=article_name)
+            cn8 = self._get_cn8(cn8_code=data["CODE"])
             if not cn8:
                 logger.error(f"Error while creating item for \n{data}")
                 logger.error(f"Skipped")
                 self._pages_to_double_check.append(data["page_number"])
                 continue
-            remise = float(data["Rem. %"].replace(",", ".")) / 100
+            remise = data["Rem. %"] / 100
             if remise > 0:
                 logger.info(f"got remise: {remise} for page: {data['page_number']}")
             invoicedAmount=round(data["Montant HT"] * (1 - remise))
@@ -228,7 +284,7 @@ class DolvikaFactureReader:
                 CN8=cn8,
                 MSConsDestCode=self.get_country_code(data["dest_country"]),
                 countryOfOriginCode="FR",
-                netMass=round(self._get_weight(article_name=article_name) * data["Quantité"]),
+                netMass=round(self._get_weight(weight=data["POIDS/ARTICLE"]) * data["Quantité"]),
                 quantityInSU=data["Quantité"],
                 invoicedAmount=invoicedAmount,
                 statisticalProcedureCode=21,
@@ -250,6 +306,7 @@ class DolvikaFactureReader:
         has_no_nulls = not df['Numéro'].isnull().any()
         if not has_no_nulls:
             raise ValueError(f"Got df with null value in column Numéro")    # make sure Numéro is not empty
+        df = self._add_article_info(df=df)
         declarations = []
         for _, group_data in df.groupby("Numéro"):     # each facture is 1 declaration
             metadata_dict = group_data.iloc[0]
@@ -271,16 +328,22 @@ class DolvikaFactureReader:
         return declarations
 
 
-    def _get_cn8(self, article_name:str) -> Union[CN8, None]:
-        cn8_code = self.article_info.get_article_info(article_name=article_name, target_col='CODE')
+    def _add_article_info(self, df:pd.DataFrame) -> pd.DataFrame:
+        # CODE & POIDS/ARTICLE of each item, the distinct articles of the pdf are resolved once
+        article_info = self.article_info.resolve_many(df["Désignation"])
+        df = df.copy()
+        df["CODE"] = article_info["CODE"].to_numpy()
+        df["POIDS/ARTICLE"] = article_info["POIDS/ARTICLE"].to_numpy()
+        return df
+
+    def _get_cn8(self, cn8_code) -> Union[CN8, None]:
         if cn8_code:
             cn8 = CN8(
                 CN8Code=str(cn8_code)
             )
             return cn8
     
-    def _get_weight(self, article_name:str) -> float:
-        weight = self.article_info.get_article_info(article_name = article_name, target_col='POIDS/ARTICLE')
+    def _get_weight(self, weight) -> float:
         if weight:
             return weight
         else:
@@ -0,0 +1,131 @@
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Union
+
+import pdfplumber
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LTChar, LTContainer
+from pdfminer.pdfinterp import PDFPageInterpreter
+from pdfplumber.page import Page
+from pdfplumber.utils.exceptions import PdfminerException
+
+
+PdfSource = Union[Path, BinaryIO]
+
+
+def as_pdf_source(pdf:Union[Path, str, bytes, BinaryIO]) -> PdfSource:
+    # paths are opened from disk, bytes and file-like objects (e.g. a streamlit upload) are read from memory
+    if isinstance(pdf, (bytes, bytearray)):
+        return BytesIO(pdf)
+    if isinstance(pdf, str):
+        return Path(pdf)
+    return pdf
+
+
+def get_pdf_name(pdf:PdfSource) -> str:
+    # file name for the logs and the outputs, streams without a name get a placeholder
+    if isinstance(pdf, Path):
+        return pdf.name
+    return Path(getattr(pdf, "name", None) or "memory.pdf").name
+
+
+class TextOnlyAggregator(PDFPageAggregator):
+    # drops the paths (rects, lines, curves) and images while the page is interpreted, only chars are laid out
+
+    def paint_path(self, *args, **kwargs) -> None:
+        pass
+
+    def render_image(self, *args, **kwargs) -> None:
+        pass
+
+
+class TextPage(Page):
+    """
+    pdfplumber Page with only its chars, as minimal dicts with the keys used by the text & word extraction.
+    Same geometry as a pdfplumber page (bbox, top, doctop, ...), so crops and text lines give the same result,
+    but find_tables finds nothing, there are no edges.
+    """
+
+    @property
+    def layout(self):
+        if hasattr(self, "_layout"):
+            return self._layout
+        device = TextOnlyAggregator(self.pdf.rsrcmgr, pageno=self.page_number, laparams=None)
+        interpreter = PDFPageInterpreter(self.pdf.rsrcmgr, device)
+        try:
+            interpreter.process_page(self.page_obj)
+        except Exception as e:
+            raise PdfminerException(e)
+        self._layout = device.get_result()
+        return self._layout
+
+    def parse_objects(self) -> Dict[str, List[Dict]]:
+        return {"char": list(self._iter_chars(self.layout._objs))}
+
+    def _iter_chars(self, layout_objects:List) -> Dict:
+        mb_x0, mb_top = self.mediabox[:2]
+        for obj in layout_objects:
+            if isinstance(obj, LTContainer):    # LTFigure
+                yield from self._iter_chars(obj._objs)
+            elif isinstance(obj, LTChar):
+                top = (self.height - obj.y1) + mb_top
+                yield {
+                    "object_type": "char",
+                    "page_number": self.page_number,
+                    "text": obj.get_text(),
+                    "fontname": obj.fontname,
+                    "size": obj.size,
+                    "upright": obj.upright,
+                    "matrix": obj.matrix,
+                    "x0": obj.x0 + mb_x0,
+                    "x1": obj.x1 + mb_x0,
+                    "y0": obj.y0,
+                    "y1": obj.y1,
+                    "width": obj.width,
+                    "height": obj.height,
+                    "top": top,
+                    "bottom": (self.height - obj.y0) + mb_top,
+                    "doctop": self.initial_doctop + top,
+                }
+
+
+class TextPdf(pdfplumber.PDF):
+    # pdfplumber PDF whose pages are TextPage
+
+    @property
+    def pages(self) -> List[TextPage]:
+        if hasattr(self, "_text_pages"):
+            return self._text_pages
+        self._text_pages = [
+            TextPage(self, page.page_obj, page_number=page.page_number, initial_doctop=page.initial_doctop)
+            for page in super().pages
+        ]
+        return self._text_pages
+
+
+class PdfplumberBackend:
+    """Full pdfplumber pages, with the rects, lines and curves find_tables needs."""
+
+    name = "pdfplumber"
+
+    @staticmethod
+    def open(pdf_path:PdfSource) -> pdfplumber.PDF:
+        return pdfplumber.open(pdf_path)
+
+
+class TextBackend:
+    """Chars only, for the readers that only match regexes on text lines and never call find_tables."""
+
+    name = "text"
+
+    @staticmethod
+    def open(pdf_path:PdfSource) -> TextPdf:
+        return TextPdf.open(pdf_path)
+
+
+backend_mapping = {backend.name: backend for backend in (PdfplumberBackend, TextBackend)}
+
+
+def open_pdf(reader) -> pdfplumber.PDF:
+    # opens the reader's pdf (path or stream) with the backend the reader declares in its extraction_backend class attribute
+    return backend_mapping[reader.extraction_backend].open(reader.pdf_path)
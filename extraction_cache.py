@@ -0,0 +1,155 @@
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Union
+from contextlib import contextmanager
+import hashlib
+import pickle
+import sqlite3
+import time
+
+from loguru import logger
+
+from page_pool import PageResult
+
+
+def stream_sha256(stream:BinaryIO) -> str:
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: stream.read(1024 * 1024), b""):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def file_sha256(path:Path) -> str:
+    with open(path, "rb") as f:
+        return stream_sha256(f)
+
+
+class ExtractionCache:
+    """
+    Local SQLite store of the per-page extraction results (item rows with their metadata, pages to double check),
+    keyed by pdf SHA-256 + page number + reader class + reader layout_version.
+    A document is only read back when all its pages were stored, and the least recently used documents are evicted above max_bytes.
+    Also keeps the company detected from the first page of each pdf, with the detection key it was detected with.
+    """
+
+    def __init__(self, db_path:Path, max_bytes:int = 512 * 1024 * 1024) -> None:
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._hashes = {}
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "pdf_hash TEXT, reader TEXT, layout_version INTEGER, number_of_pages INTEGER, size INTEGER, last_access REAL, "
+                "PRIMARY KEY (pdf_hash, reader, layout_version))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "pdf_hash TEXT, reader TEXT, layout_version INTEGER, page_number INTEGER, value BLOB, "
+                "PRIMARY KEY (pdf_hash, reader, layout_version, page_number))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(fingerprints)")]
+            if columns and "detection_key" not in columns:
+                conn.execute("DROP TABLE fingerprints")     # stored without detection key, the pdfs are detected again
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "pdf_hash TEXT, detection_key TEXT, company_name TEXT, "
+                "PRIMARY KEY (pdf_hash, detection_key))"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # no connection is kept on self, the cache is pickled with the reader into the worker processes
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:  # commit or rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def _get_hash(self, pdf_path:Union[Path, BinaryIO]) -> str:
+        if not isinstance(pdf_path, Path):
+            # in-memory pdf, hashed each time, the stream is left where it was
+            position = pdf_path.tell()
+            pdf_path.seek(0)
+            pdf_hash = stream_sha256(pdf_path)
+            pdf_path.seek(position)
+            return pdf_hash
+        stat = Path(pdf_path).stat()
+        file_id = (str(pdf_path), stat.st_mtime, stat.st_size)
+        if file_id not in self._hashes:
+            self._hashes[file_id] = file_sha256(pdf_path)
+        return self._hashes[file_id]
+
+    def _get_key(self, reader) -> tuple:
+        return (self._get_hash(reader.pdf_path), type(reader).__name__, reader.layout_version)
+
+    def get_fingerprint(self, pdf_path:Path, detection_key:str) -> Union[str, None]:
+        # company name detected from the first page of this pdf on a previous run, with the same detection key
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT company_name FROM fingerprints WHERE pdf_hash=? AND detection_key=?", (self._get_hash(pdf_path), detection_key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, pdf_path:Path, detection_key:str, company_name:str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM fingerprints WHERE pdf_hash=?", (self._get_hash(pdf_path),))     # detections of older keys
+            conn.execute("INSERT INTO fingerprints VALUES (?, ?, ?)", (self._get_hash(pdf_path), detection_key, company_name))
+
+    def get_page_results(self, reader) -> Union[List[PageResult], None]:
+        key = self._get_key(reader)
+        with self._connect() as conn:
+            document = conn.execute(
+                "SELECT number_of_pages FROM documents WHERE pdf_hash=? AND reader=? AND layout_version=?", key
+            ).fetchone()
+            if document is None:
+                return None
+            rows = conn.execute(
+                "SELECT value FROM pages WHERE pdf_hash=? AND reader=? AND layout_version=? ORDER BY page_number", key
+            ).fetchall()
+            if len(rows) != document[0]:
+                logger.warning(f"extraction cache of {reader.pdf_name} is incomplete, extracting again")
+                return None
+            conn.execute(
+                "UPDATE documents SET last_access=? WHERE pdf_hash=? AND reader=? AND layout_version=?", (time.time(), *key)
+            )
+        logger.info(f"using extraction cache for {reader.pdf_name}, {len(rows)} pages")
+        return [PageResult(*pickle.loads(row[0])) for row in rows]
+
+    def record_page_results(self, reader, page_results:Iterable[PageResult]) -> Iterator[PageResult]:
+        # store the results while passing them through, the document is only marked complete once all pages went through
+        key = self._get_key(reader)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM documents WHERE pdf_hash=? AND reader=? AND layout_version=?", key)
+            conn.execute("DELETE FROM pages WHERE pdf_hash=? AND reader=? AND layout_version=?", key)
+        number_of_pages = 0
+        size = 0
+        for page_result in page_results:
+            value = pickle.dumps(tuple(page_result), protocol=pickle.HIGHEST_PROTOCOL)
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (*key, page_result.page_number, value))
+            number_of_pages += 1
+            size += len(value)
+            yield page_result
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)", (*key, number_of_pages, size, time.time()))
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._connect() as conn:
+            documents = conn.execute(
+                "SELECT pdf_hash, reader, layout_version, size FROM documents ORDER BY last_access DESC"
+            ).fetchall()
+            total_size = 0
+            for pdf_hash, reader, layout_version, size in documents:
+                total_size += size
+                if total_size > self.max_bytes:
+                    logger.debug(f"evicting {reader} extraction of {pdf_hash} from extraction cache")
+                    conn.execute("DELETE FROM documents WHERE pdf_hash=? AND reader=? AND layout_version=?", (pdf_hash, reader, layout_version))
+                    conn.execute("DELETE FROM pages WHERE pdf_hash=? AND reader=? AND layout_version=?", (pdf_hash, reader, layout_version))
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM documents")
+            conn.execute("DELETE FROM pages")
+            conn.execute("DELETE FROM fingerprints")
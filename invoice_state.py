@@ -0,0 +1,52 @@
+from typing import Dict, Iterable, Iterator, NamedTuple, Tuple, Union
+
+import pandas as pd
+
+
+class InvoicePage(NamedTuple):
+    # what one page says on its own, extracted without looking at the other pages
+    invoice_number: Union[str, None]     # invoice the page belongs to, when the page says it
+    is_first_page: bool     # the page opens its invoice, else it continues the open one
+    header: Union[Dict, None]     # invoice-level fields found on the page (number, date, address, ...), None when not found
+    fields: Dict     # other page-level values the reduce needs, like the remise
+    df: Union[pd.DataFrame, None]     # items of the page, without the invoice-level columns
+    error: Union[str, None]     # error while extracting the page, the page is double checked
+
+
+class InvoiceState:
+    """
+    Invoices of one pdf, fed with the pages in page order: a first page opens an invoice with its header,
+    the next pages continue the open invoice, and opening another invoice closes it.
+    Pages can then be extracted independently (in parallel, from the cache, or only some of them again),
+    the invoice-level fields of each page are resolved by this cheap ordered pass.
+    """
+
+    def __init__(self) -> None:
+        self.invoices = {}     # invoice number: header, the first header seen for a number is kept unless replaced
+        self.open_invoice_number = None
+
+    def open(self, invoice_number:str, header:Dict, replace:bool = False) -> Dict:
+        # replace=True when a first page seen again for the same number replaces its header
+        if replace or invoice_number not in self.invoices:
+            self.invoices[invoice_number] = header
+        self.open_invoice_number = invoice_number
+        return self.invoices[invoice_number]
+
+    def continue_invoice(self, invoice_number:str) -> Dict:
+        if self.open_invoice_number is None:
+            raise ValueError(f"page continues invoice {invoice_number} but no invoice is open")
+        if invoice_number != self.open_invoice_number:
+            raise ValueError(f"page continues invoice {invoice_number} but the open invoice is {self.open_invoice_number}")
+        return self.invoices[invoice_number]
+
+
+def iter_with_next(iterable:Iterable) -> Iterator[Tuple]:
+    # (item, next item or None), for the reduce steps looking one page ahead
+    iterator = iter(iterable)
+    previous = next(iterator, None)
+    if previous is None:
+        return
+    for item in iterator:
+        yield previous, item
+        previous = item
+    yield previous, None
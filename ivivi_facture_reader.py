@@ -1,16 +1,21 @@
-
 from pathlib import Path
-from typing import List, Union, Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple, Union
 import re
 from datetime import datetime
 
-import pdfplumber
 from loguru import logger
 import pandas as pd
 import numpy as np
 
 from data_model import Party, Item_unit, Declaration_unit, CN8, Envelope, DateTime, Function, Instat
 from article_info import Article_Info
+from page_pool import PageResult, iter_page_dfs
+from extraction_cache import ExtractionCache
+from extraction_backend import as_pdf_source, get_pdf_name
+from page_layout import PageLayout
+from invoice_state import InvoicePage, InvoiceState, iter_with_next
+from table_template import TableTemplate
+from number_parser import parse_french_number, parse_french_numbers
 
 
 class IviviFactureReader:
@@ -23,14 +28,35 @@ class IviviFactureReader:
     envelopeId = "S4U3"
     declarationTypeCode = 1     # 1 or 4 depends on company,
     if_xml: bool = True
-
-    def __init__(self, pdf_path:Path, article_info: Article_Info, output_folder_path:Path) -> None:
-        self.pdf_path = pdf_path
+    page_keywords = ["Description", "N° de Tva intracom"]     # pages without any of these words are skipped before find_tables, metadata only pages are kept for the next pages
+    layout_version = 2     # bump when the page extraction changes, to invalidate the extraction cache
+    extraction_backend = "pdfplumber"     # full pages, find_tables needs their rects and lines
+    retry_strategies = ["next_page_remise"]     # alternate ways to extract a page, for the pages to double check
+    page_time_budget = None     # seconds, pages taking longer are given up and double checked, None for no limit
+    patterns = {     # compiled once per class, the page and item loops only use these
+        "remise": re.compile(r'Remise (\d+,\d+)%'),
+        "country_code": re.compile(r'^[A-Za-z]+'),
+    }
+    metadata_header = ['Numéro', 'Date', 'Code client', 'Date échéance', 'Mode de règlement', 'N° de Tva intracom']     # header rows the table templates are pinned on
+    item_header = ['Code', 'Description', 'Qté', 'P.U. HT', 'Montant HT', 'TVA']
+
+    def __init__(self, pdf_path:Union[Path, bytes, BinaryIO], article_info: Article_Info, output_folder_path:Union[Path, None], workers:int = 1, extraction_cache:ExtractionCache = None, page_numbers:List[int] = None, strategy:str = None, page_time_budget:float = None, pdf_name:str = None) -> None:
+        self.pdf_path = as_pdf_source(pdf_path)     # path, or stream for a pdf kept in memory
+        self.pdf_name = pdf_name or get_pdf_name(self.pdf_path)
         self.article_info = article_info
-        self.output_xml_path = output_folder_path / f"{self.pdf_path.stem}.xml"
-        self._previous_page_metadata = {}
+        self.output_xml_path = output_folder_path / f"{Path(self.pdf_name).stem}.xml" if output_folder_path is not None else None     # None to keep the xml in memory only
+        self.xml_bytes = None
         self._pages_to_double_check = []
+        self._page_reasons = {}    # page_number: reason, for pages skipped before extraction or given up
         self.df_item_all = None
+        self.workers = workers     # > 1 to extract pages in parallel worker processes
+        self.extraction_cache = extraction_cache     # reuse the page extraction of a previous run on the same pdf
+        self.page_numbers = page_numbers     # only extract again these pages, merged into the previous extraction in the cache
+        self.strategy = strategy     # one of retry_strategies, to extract again the pages to double check differently
+        if page_time_budget is not None:
+            self.page_time_budget = page_time_budget
+        self.metadata_template = TableTemplate(header=self.metadata_header)     # table lines learned from the first detected tables, skip detection on the next pages
+        self.item_template = TableTemplate(header=self.item_header)
 
     @property
     def pages_to_double_check(self) -> List:
@@ -39,122 +65,176 @@ class IviviFactureReader:
     def run(self) -> Union[pd.DataFrame, None]:
         instat = self.get_instat()
         df_envelope = instat.Envelope.to_df()   # not always match with df_item_all, because df_item could have item doesn't match code in data\DONNEES DOUANE PYTHON.xlsx
-        instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
+        self.xml_bytes = instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
         logger.warning(f"All page_numbers (skipped) to double check : {self._pages_to_double_check}")
-        instat.validate_xml(xml_file=self.output_xml_path)
+        if self._page_reasons:
+            logger.warning(f"Reasons of the skipped pages : {self._page_reasons}")
+        instat.validate_xml(xml_file=self.xml_bytes)
         if self.df_item_all is not None:
             return self.df_item_all
 
-    def _get_remise(self, page, next_page=None) -> float:
-        remise = self._get_remise_from_text(text=page.extract_text_simple())
+    def _get_remise(self, page_number:int, remise:Union[float, None], next_remise:Union[float, None], strategy:Union[str, None] = None) -> float:
+        # remise read on the page, or on the next page, next_remise is None when there is no next page,
+        # strategy is the one the page was extracted with
+        if strategy == "next_page_remise" and next_remise is not None:
+            # the remise of the next page first, when the page has a wrong one
+            return next_remise
         if remise is not None:
             return remise
         else:
-            if next_page:
-                remise = self._get_remise_from_text(text=next_page.extract_text_simple())
-                logger.warning(f"can't get remise from page: {page.page_number}, looking at next page: {next_page.page_number}")
-                if remise is not None:
-                    return remise
-        raise ValueError(f"Can't find remise for page: {page.page_number}")
+            logger.warning(f"can't get remise from page: {page_number}, looking at next page: {page_number + 1}")
+            if next_remise is not None:
+                return next_remise
+        raise ValueError(f"Can't find remise for page: {page_number}")
 
     def _get_remise_from_text(self, text) -> Union[float, None]:
-        match = re.search(r'Remise (\d+,\d+)%', text)
+        match = self.patterns["remise"].search(text)
 
         # Check if a match was found
         if match:
             remise = match.group(1)  # Extract the matched text
-            remise = float(remise.replace(",", ".")) / 100
+            remise = parse_french_number(remise) / 100
             logger.info(f"Got Remise: {remise}")
             return remise
 
     def get_instat(self) -> Instat:
-        with pdfplumber.open(self.pdf_path) as pdf:
-            dfs = []
-            for page_index, page in enumerate(pdf.pages):
-                if page_index < len(pdf.pages) - 1:
-                    next_page = pdf.pages[page_index+1]
+        dfs = iter_page_dfs(reader=self)
+        df = pd.concat(dfs, axis=0)
+        self.df_item_all = df.copy()
+        envelope = self._get_envelope(df=df)
+        instat = Instat(Envelope=envelope)
+        return instat
+
+    def _get_skip_reason(self, text:str) -> Union[str, None]:
+        # cheap check on the page text before find_tables & crops, boilerplate pages (terms and conditions, blank versos, ...) have no item table header
+        if not any(keyword in text for keyword in self.page_keywords):
+            return f"no item table header {self.page_keywords} found"
+
+    def _iter_page_results(self, pdf, page_indices) -> Iterator[Tuple[int, InvoicePage]]:
+        # (page_number, InvoicePage) for every page, the pages don't depend on each other, _reduce_invoice_pages does
+        for page_index in page_indices:
+            page = pdf.pages[page_index]
+            layout = PageLayout(page)
+            text = layout.text()
+            if page.page_number == 1:
+                # just to double check if the pdf is matched with party name
+                if self.party.partyName not in text:
+                    raise ValueError(f"{self.party.partyName} not found in {self.pdf_name}, page: {page.page_number}, probably wrong input pdf")
+            skip_reason = self._get_skip_reason(text)
+            if skip_reason:
+                logger.info(f"skipped page number: {page.page_number}, {skip_reason}")
+                self._pages_to_double_check.append(page.page_number)
+                self._page_reasons[page.page_number] = skip_reason
+                page.close()
+                # only the remise, the previous page may need it
+                yield page.page_number, InvoicePage(invoice_number=None, is_first_page=False, header=None, fields={"remise": self._get_remise_from_text(text=text), "strategy": self.strategy}, df=None, error=None)
+                continue
+            logger.info(f"extracting information from page number: {page.page_number}")
+            invoice_page = self._get_invoice_page(layout=layout)
+            page.close()     # release the cached page objects, so memory doesn't grow with the number of pages
+            yield page.page_number, invoice_page
+
+    def _reduce_invoice_pages(self, page_results:Iterable[PageResult]) -> Iterator[PageResult]:
+        # ordered pass over the extracted pages: remise of the page or the next one, first pages open their facture,
+        # the next pages use its metadata, then the page items are checked
+        invoices = InvoiceState()
+        for page_result, next_page_result in iter_with_next(page_results):
+            page_number = page_result.page_number
+            if page_number in page_result.page_reasons:
+                yield page_result._replace(invoice_page=None)   # skipped page
+                continue
+            invoice_page = page_result.invoice_page
+            next_remise = None
+            if next_page_result is not None and next_page_result.page_number == page_number + 1 and next_page_result.invoice_page is not None:
+                next_remise = next_page_result.invoice_page.fields["remise"]
+            pages_to_double_check = list(page_result.pages_to_double_check)
+            page_df = None
+            try:
+                remise = self._get_remise(page_number=page_number, remise=invoice_page.fields["remise"], next_remise=next_remise, strategy=invoice_page.fields.get("strategy"))
+                if invoice_page.error:
+                    raise ValueError(invoice_page.error)
+                df_item = invoice_page.df
+                # use previous page's metadata if current page has previous page Numéro
+                if invoice_page.is_first_page:
+                    metadata_dict = None
+                    if invoice_page.header:
+                        metadata_dict = {**invoice_page.header, "page_number": page_number, "remise": remise}
+                        invoices.open(metadata_dict["Numéro"], metadata_dict, replace=True)
+                    if df_item.empty:
+                        logger.error(f"can't find item table or is empty while this is the first page for the facture, please double check page number: {page_number}")
+                        pages_to_double_check.append(page_number)
+                    if not metadata_dict:
+                        raise ValueError(f"can't find metadata dict")
                 else:
-                    next_page = None
-                text = page.extract_text_simple()
-                if page.page_number == 1:
-                    # just to double check if the pdf is matched with party name
-                    if self.party.partyName not in text:
-                        raise ValueError(f"{self.party.partyName} not found in {self.pdf_path}, page: {page.page_number}, probably wrong input pdf")
-                try:
-                    logger.info(f"extracting information from page number: {page.page_number}")
-                    df_item = self._get_full_df_from_page(page=page, next_page=next_page)
-                    logger.debug(df_item)
-                    if not df_item.empty:
-                        # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
-                        is_good_tva = df_item['N° de Tva intracom'].str.len().gt(3).all()
-                        logger.debug(f"Checked is_good_tva: {is_good_tva}")
-                        if is_good_tva:
-                            dfs.append(df_item)
-                        else:
-                            logger.warning(f"Skipped because N° de Tva intracom is not good")
-                            self._pages_to_double_check.append(page.page_number)
-                except Exception as e:
-                    logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
-                    self._pages_to_double_check.append(page.page_number)
-                    continue
-            df = pd.concat(dfs, axis=0)
-            self.df_item_all = df.copy()
-            envelope = self._get_envelope(df=df)
-            instat = Instat(Envelope=envelope)
-            return instat
-
-    def _check_is_second_page(self, page) -> str:
-        text = page.extract_text_simple()
+                    metadata_dict = invoices.continue_invoice(invoice_page.invoice_number)
+                    logger.success(f"not find metadata_dict, using previous page's : {metadata_dict}")
+
+                for k, v in metadata_dict.items():  # add metadata dict into df_items
+                    df_item[k] = v
+                logger.debug(df_item)
+                if not df_item.empty:
+                    # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
+                    is_good_tva = df_item['N° de Tva intracom'].str.len().gt(3).all()
+                    logger.debug(f"Checked is_good_tva: {is_good_tva}")
+                    if is_good_tva:
+                        page_df = df_item
+                    else:
+                        logger.warning(f"Skipped because N° de Tva intracom is not good")
+                        pages_to_double_check.append(page_number)
+            except Exception as e:
+                logger.error(f"Error while processing page : {page_number}, skipped, error: {e}")
+                pages_to_double_check.append(page_number)
+            yield page_result._replace(df=page_df, pages_to_double_check=pages_to_double_check, invoice_page=None)
+
+    def _check_is_second_page(self, layout:PageLayout) -> str:
+        text = layout.text()
         if text.startswith(f"Facture N°"):
             first_line = text.split("\n")[0] 
             facture_number = first_line.split(" ")[-1]
-            logger.debug(f"{page.page_number} is not a first page for facture number: {facture_number}")
+            logger.debug(f"{layout.page_number} is not a first page for facture number: {facture_number}")
             return facture_number
         else:
-            logger.debug(f"{page.page_number} is the first page for the facture")
-
-    def _get_full_df_from_page(self, page, next_page) -> pd.DataFrame:
-        facture_number = self._check_is_second_page(page)
-        remise = self._get_remise(page=page, next_page=next_page)
-        if not facture_number:
-            is_first_page = True
-        else:
-            is_first_page = False
-
-        tables = page.find_tables()
-        metadata_dict = None
-        df_item = pd.DataFrame([])
-        for table in tables:
-            # loop over tables to get df_item and metadata_dict
-            raw_data = self._remove_empty_items(table.extract())    # remove things like ["", None, None, None, None]
-            if not metadata_dict:
-                metadata_dict = self._get_metadata_dict(raw_data)
-                if metadata_dict:
-                    metadata_dict["page_number"] = page.page_number
-                    metadata_dict["remise"] = remise
-                    if not metadata_dict.get("N° de Tva intracom"):
-                        logger.warning(f"missing N° de Tva intracom !")
-                logger.debug(f"got metadata_dict: {metadata_dict}")
-            if df_item.empty:
-                df_item = self._get_item_df(raw_data)
-
-        # use previous page's metadata if current page has previous page Numéro
-        if is_first_page:
-            if metadata_dict:
-                self._previous_page_metadata = metadata_dict
-            if df_item.empty:
-                logger.error(f"can't find item table or is empty while this is the first page for the facture, please double check page number: {page.page_number}")
-                self._pages_to_double_check.append(page.page_number)
-        else:
-            if self._previous_page_metadata["Numéro"] == facture_number:
-                logger.success(f"not find metadata_dict, using previous page's : {self._previous_page_metadata}")
-                metadata_dict = self._previous_page_metadata
-            else:
-                raise ValueError(f"can't find metadata dict")
-
-        for k, v in metadata_dict.items():  # add metadata dict into df_items
-            df_item[k] = v
-        return df_item
+            logger.debug(f"{layout.page_number} is the first page for the facture")
+
+    def _get_invoice_page(self, layout:PageLayout) -> InvoicePage:
+        # metadata, remise and items of the page on its own, errors are kept for _reduce_invoice_pages
+        facture_number = self._check_is_second_page(layout)
+        fields = {"remise": self._get_remise_from_text(text=layout.text()), "strategy": self.strategy}     # the strategy stays with the page in the cache
+        try:
+            raw_tables = self._get_pinned_tables(layout.page)
+            if raw_tables is None:
+                raw_tables = []
+                for table in layout.page.find_tables():
+                    rows = table.extract()
+                    self.metadata_template.learn(table, rows)
+                    self.item_template.learn(table, rows)
+                    raw_tables.append(rows)
+            metadata_dict = None
+            df_item = pd.DataFrame([])
+            for rows in raw_tables:
+                # loop over tables to get df_item and metadata_dict
+                raw_data = self._remove_empty_items(rows)    # remove things like ["", None, None, None, None]
+                if not metadata_dict:
+                    metadata_dict = self._get_metadata_dict(raw_data)
+                    if metadata_dict:
+                        if not metadata_dict.get("N° de Tva intracom"):
+                            logger.warning(f"missing N° de Tva intracom !")
+                    logger.debug(f"got metadata_dict: {metadata_dict}")
+                if df_item.empty:
+                    df_item = self._get_item_df(raw_data)
+        except Exception as e:
+            return InvoicePage(invoice_number=facture_number, is_first_page=not facture_number, header=None, fields=fields, df=None, error=str(e))
+        return InvoicePage(invoice_number=facture_number, is_first_page=not facture_number, header=metadata_dict, fields=fields, df=df_item, error=None)
+
+    def _get_pinned_tables(self, page) -> Union[List, None]:
+        # metadata and item table rows from the templates, None when one of them doesn't fit, like on the pages without metadata table
+        metadata_rows = self.metadata_template.pinned_rows(page)
+        if metadata_rows is None:
+            return None
+        item_rows = self.item_template.pinned_rows(page)
+        if item_rows is None:
+            return None
+        return [metadata_rows, item_rows]
 
     def _remove_empty_items(self, input_list: List) -> List:
         output_list = []
@@ -173,7 +253,7 @@ class IviviFactureReader:
         return output_list
 
     def _get_metadata_dict(self, raw_data: List) -> Union[Dict, None]:
-        item_to_match = ['Numéro', 'Date', 'Code client', 'Date échéance', 'Mode de règlement', 'N° de Tva intracom']
+        item_to_match = self.metadata_header
         array = np.array(raw_data)
         if array.shape == (2, len(item_to_match)):
             if raw_data[0] == item_to_match:
@@ -181,7 +261,7 @@ class IviviFactureReader:
                 return result_dict
 
     def _get_item_df(self, raw_data: List) -> pd.DataFrame:
-        item_to_match = ['Code', 'Description', 'Qté', 'P.U. HT', 'Montant HT', 'TVA']
+        item_to_match = self.item_header
         array = np.array(raw_data)
         if array.shape == (2, len(item_to_match)):
             if raw_data[0] == item_to_match:
@@ -189,10 +269,7 @@ class IviviFactureReader:
                 data = self._prepare_data_for_item_df(result_dict=result_dict, raw_1_data=raw_data[1])
                 df = pd.DataFrame(data)
                 numeric_columns = ['Qté', 'P.U. HT', 'Montant HT', 'TVA']
-                for col in numeric_columns:
-                    df[col] = df[col].str.replace(',', '.')
-                    df[col] = df[col].str.replace(' ', '')
-                    df[col] = df[col].astype(float)
+                df = parse_french_numbers(df, numeric_columns)
                 # round Montant HT
                 df['Montant HT'] = df['Montant HT'].round()
                 return df
@@ -233,7 +310,7 @@ class IviviFactureReader:
 
     def _get_chars_only(self, input_str:str) -> str:
         if input_str:
-            chars_only = re.match(r'^[A-Za-z]+', input_str)
+            chars_only = self.patterns["country_code"].match(input_str)
             if chars_only:
                 output = chars_only.group()  # Extract the matched part
                 if output == "ESB":
@@ -248,8 +325,7 @@ class IviviFactureReader:
         output_list = []
         for index, data in df.iterrows():
             item_number = index + 1
-            article_name=data["Description"]
-            cn8 = self._get_cn8(article_name=article_name)
+            cn8 = self._get_cn8(cn8_code=data["CODE"])
             if not cn8:
                 logger.error(f"Error while creating item for \n{data}")
                 logger.error(f"Skipped")
@@ -261,7 +337,7 @@ class IviviFactureReader:
                 CN8=cn8,
                 MSConsDestCode=self._get_chars_only(data["N° de Tva intracom"]),
                 countryOfOriginCode="CN",
-                netMass=round(self._get_weight(article_name=article_name) * data["Qté"]),
+                netMass=round(self._get_weight(weight=data["POIDS/ARTICLE"]) * data["Qté"]),
                 quantityInSU=data["Qté"],
                 invoicedAmount=invoicedAmount,
                 statisticalProcedureCode=21,
@@ -283,6 +359,7 @@ class IviviFactureReader:
         has_no_nulls = not df['Numéro'].isnull().any()
         if not has_no_nulls:
             raise ValueError(f"Got df with null value in column Numéro")    # make sure Numéro is not empty
+        df = self._add_article_info(df=df)
         declarations = []
         for _, group_data in df.groupby("Numéro"):     # each facture is 1 declaration
             metadata_dict = group_data.iloc[0]
@@ -304,16 +381,22 @@ class IviviFactureReader:
         return declarations
 
 
-    def _get_cn8(self, article_name:str) -> Union[CN8, None]:
-        cn8_code = self.article_info.get_article_info(article_name=article_name, target_col='CODE')
+    def _add_article_info(self, df:pd.DataFrame) -> pd.DataFrame:
+        # CODE & POIDS/ARTICLE of each item, the distinct articles of the pdf are resolved once
+        article_info = self.article_info.resolve_many(df["Description"])
+        df = df.copy()
+        df["CODE"] = article_info["CODE"].to_numpy()
+        df["POIDS/ARTICLE"] = article_info["POIDS/ARTICLE"].to_numpy()
+        return df
+
+    def _get_cn8(self, cn8_code) -> Union[CN8, None]:
         if cn8_code:
             cn8 = CN8(
                 CN8Code=str(cn8_code)
             )
             return cn8
     
-    def _get_weight(self, article_name:str) -> float:
-        weight = self.article_info.get_article_info(article_name = article_name, target_col='POIDS/ARTICLE')
+    def _get_weight(self, weight) -> float:
         if weight:
             return weight
         else:
@@ -1,10 +1,9 @@
 
 from pathlib import Path
-from typing import List, Union, Dict
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
 import re
 from datetime import datetime
 
-import pdfplumber
 from loguru import logger
 import pandas as pd
 import numpy as np
@@ -12,6 +11,12 @@ import pycountry
 
 from data_model import Party, Item_unit, Declaration_unit, CN8, Envelope, DateTime, Function, Instat
 from article_info import Article_Info
+from page_pool import iter_page_dfs
+from extraction_cache import ExtractionCache
+from extraction_backend import as_pdf_source, get_pdf_name
+from page_layout import PageLayout
+from table_template import TableTemplate
+from number_parser import parse_french_numbers
 
 
 class JessyFactureReader:
@@ -24,14 +29,37 @@ class JessyFactureReader:
     envelopeId = "L5B7"
     declarationTypeCode = 1     # 1 or 4 depends on company,
     if_xml: bool = True
-
-    def __init__(self, pdf_path:Path, article_info: Article_Info, output_folder_path:Path) -> None:
-        self.pdf_path = pdf_path
+    page_keywords = ["Désignation"]     # pages without any of these words are skipped before find_tables
+    layout_version = 1     # bump when the page extraction changes, to invalidate the extraction cache
+    extraction_backend = "pdfplumber"     # full pages, find_tables needs their rects and lines
+    retry_strategies = ["flip_mode"]     # alternate ways to extract a page, for the pages to double check
+    page_time_budget = None     # seconds, pages taking longer are given up and double checked, None for no limit
+    patterns = {     # compiled once per class, the page and item loops only use these
+        "tva": re.compile(r"^\w{2}\w?\d+\w*\d+$"),
+        "country_code": re.compile(r'^[A-Za-z]+'),
+        "description_word": re.compile(r"\b([A-Za-z]*)(?i:TUNIQUE)\d+|\b([A-Za-z]+[0-9]?)\b"),
+        "postal_code": re.compile(r'^[0-9]{5}$'),
+    }
+    words_to_remove = {"HS", "ELASTAIN", "POLIESTER", "ACRYLIQUE", "ELASATIN"}     # dropped from the descriptions in hard mode, uppercase
+    item_header = ['Désignation', 'Quantité', 'P.U. HT', '% REM', 'Remise HT', 'Montant HT']     # header row of the item table, the table template is pinned on it
+
+    def __init__(self, pdf_path:Union[Path, bytes, BinaryIO], article_info: Article_Info, output_folder_path:Union[Path, None], workers:int = 1, extraction_cache:ExtractionCache = None, page_numbers:List[int] = None, strategy:str = None, page_time_budget:float = None, pdf_name:str = None) -> None:
+        self.pdf_path = as_pdf_source(pdf_path)     # path, or stream for a pdf kept in memory
+        self.pdf_name = pdf_name or get_pdf_name(self.pdf_path)
         self.article_info = article_info
-        self.output_xml_path = output_folder_path / f"{self.pdf_path.stem}.xml"
+        self.output_xml_path = output_folder_path / f"{Path(self.pdf_name).stem}.xml" if output_folder_path is not None else None     # None to keep the xml in memory only
+        self.xml_bytes = None
         self._previous_page_metadata = {}
         self._pages_to_double_check = []
+        self._page_reasons = {}    # page_number: reason, for pages skipped before extraction or given up
         self.df_item_all = None
+        self.workers = workers     # > 1 to extract pages in parallel worker processes
+        self.extraction_cache = extraction_cache     # reuse the page extraction of a previous run on the same pdf
+        self.page_numbers = page_numbers     # only extract again these pages, merged into the previous extraction in the cache
+        self.strategy = strategy     # one of retry_strategies, to extract again the pages to double check differently
+        if page_time_budget is not None:
+            self.page_time_budget = page_time_budget
+        self.table_template = TableTemplate(header=self.item_header)     # item table lines learned from the first detected table, skip detection on the next pages
         self.HEIGHT = 841.92004
         self.WIDTH = 595.32001
 
@@ -42,16 +70,17 @@ class JessyFactureReader:
     def run(self) -> Union[pd.DataFrame, None]:
         instat = self.get_instat()
         df_envelope = instat.Envelope.to_df()   # not always match with df_item_all, because df_item could have item doesn't match code in data\DONNEES DOUANE PYTHON.xlsx
-        instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
+        self.xml_bytes = instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
         logger.warning(f"All page_numbers (skipped) to double check : {self._pages_to_double_check}")
-        instat.validate_xml(xml_file=self.output_xml_path)
+        if self._page_reasons:
+            logger.warning(f"Reasons of the skipped pages : {self._page_reasons}")
+        instat.validate_xml(xml_file=self.xml_bytes)
         if self.df_item_all is not None:
             return self.df_item_all
 
-    def _get_address_dict(self, page) -> Dict:
+    def _get_address_dict(self, layout:PageLayout) -> Dict:
         BOUNDING_BOX = (self.WIDTH * 0.42, self.HEIGHT * 0.08, self.WIDTH , self.HEIGHT * 0.20) 
-        corp_1 = page.crop(BOUNDING_BOX)
-        lines = corp_1.extract_text_lines()
+        lines = layout.lines_in(BOUNDING_BOX)
         country = None
         tva_number = None
         for x in lines:
@@ -62,8 +91,7 @@ class JessyFactureReader:
         return {"dest_country": country, "N° TVA": tva_number}
 
     def is_tva(self, text) -> bool:
-        pattern = r"^\w{2}\w?\d+\w*\d+$"
-        if re.match(pattern, text):
+        if self.patterns["tva"].match(text):
             return True
         else:
             return False
@@ -76,11 +104,10 @@ class JessyFactureReader:
             return any(country.name.lower() == name.lower() for country in pycountry.countries)
         return any(_is_country(x) for x in names)
 
-    def _get_corp_1_info(self, page) -> Dict:
+    def _get_corp_1_info(self, layout:PageLayout) -> Dict:
 
         BOUNDING_BOX_1 = (self.WIDTH * 3/8, 0, self.WIDTH , self.HEIGHT * 1.8/22.5) 
-        corp_1 = page.crop(BOUNDING_BOX_1)
-        lines = corp_1.extract_text_lines()
+        lines = layout.lines_in(BOUNDING_BOX_1)
         res = lines[-1]["text"].split(" ")
         facture_number, date, client = res
         corp_1_dict = {
@@ -91,50 +118,68 @@ class JessyFactureReader:
         return corp_1_dict
 
     def get_instat(self) -> Instat:
-        with pdfplumber.open(self.pdf_path) as pdf:
-            dfs = []
-            for page_index, page in enumerate(pdf.pages):
-                text = page.extract_text_simple()
-                if page.page_number == 1:
-                    # just to double check if the pdf is matched with party name
-                    if self.party.partyName not in text:
-                        raise ValueError(f"{self.party.partyName} not found in {self.pdf_path}, page: {page.page_number}, probably wrong input pdf")
-                try:
-                    logger.info(f"extracting information from page number: {page.page_number}")
-                    df_item = self._get_full_df_from_page(page=page)
-                    print(df_item)
-                    if not df_item.empty:
-                        # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
-                        is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
-                        # check if dest_country is FR(France) or not using starts with "FR" or "GB"
-                        is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("Royaume-Uni").any()
-                        logger.debug(f"Checked is_good_tva: {is_good_tva}")
-                        if is_good_tva and not is_to_fr_or_gb:
-                            dfs.append(df_item)
-                        else:
-                            logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page.page_number}")
-                            self._pages_to_double_check.append(page.page_number)
+        dfs = iter_page_dfs(reader=self)
+        df = pd.concat(dfs, axis=0)
+        self.df_item_all = df.copy()
+        envelope = self._get_envelope(df=df)
+        instat = Instat(Envelope=envelope)
+        return instat
+
+    def _get_skip_reason(self, text:str) -> Union[str, None]:
+        # cheap check on the page text before find_tables & crops, boilerplate pages (terms and conditions, blank versos, ...) have no item table header
+        if not any(keyword in text for keyword in self.page_keywords):
+            return f"no item table header {self.page_keywords} found"
+
+    def _iter_page_results(self, pdf, page_indices) -> Iterator[Tuple[int, Union[pd.DataFrame, None]]]:
+        # (page_number, item DataFrame or None) for every page
+        for page_index in page_indices:
+            page = pdf.pages[page_index]
+            layout = PageLayout(page)
+            page_df = None
+            text = layout.text()
+            if page.page_number == 1:
+                # just to double check if the pdf is matched with party name
+                if self.party.partyName not in text:
+                    raise ValueError(f"{self.party.partyName} not found in {self.pdf_name}, page: {page.page_number}, probably wrong input pdf")
+            skip_reason = self._get_skip_reason(text)
+            if skip_reason:
+                logger.info(f"skipped page number: {page.page_number}, {skip_reason}")
+                self._pages_to_double_check.append(page.page_number)
+                self._page_reasons[page.page_number] = skip_reason
+                page.close()
+                yield page.page_number, None
+                continue
+            try:
+                logger.info(f"extracting information from page number: {page.page_number}")
+                df_item = self._get_full_df_from_page(layout=layout)
+                print(df_item)
+                if not df_item.empty:
+                    # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
+                    is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
+                    # check if dest_country is FR(France) or not using starts with "FR" or "GB"
+                    is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("Royaume-Uni").any()
+                    logger.debug(f"Checked is_good_tva: {is_good_tva}")
+                    if is_good_tva and not is_to_fr_or_gb:
+                        page_df = df_item
                     else:
+                        logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page.page_number}")
                         self._pages_to_double_check.append(page.page_number)
-                except Exception as e:
-                    logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
+                else:
                     self._pages_to_double_check.append(page.page_number)
-                    continue
-            df = pd.concat(dfs, axis=0)
-            self.df_item_all = df.copy()
-            envelope = self._get_envelope(df=df)
-            instat = Instat(Envelope=envelope)
-            return instat
-
-    def _get_full_df_from_page(self, page) -> pd.DataFrame:
-
-        tables = page.find_tables()
-        metadata_dict = self._get_corp_1_info(page)
-        address_dict = self._get_address_dict(page)
+            except Exception as e:
+                logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
+                self._pages_to_double_check.append(page.page_number)
+            page.close()     # release the cached page objects, so memory doesn't grow with the number of pages
+            yield page.page_number, page_df
+
+    def _get_full_df_from_page(self, layout:PageLayout) -> pd.DataFrame:
+
+        metadata_dict = self._get_corp_1_info(layout)
+        address_dict = self._get_address_dict(layout)
         metadata_dict = {**metadata_dict, **address_dict}
-        metadata_dict["page_number"] = page.page_number
-        table = tables[0]
-        raw_data = self._remove_empty_items(table.extract())    # remove things like ["", None, None, None, None]
+        metadata_dict["page_number"] = layout.page_number
+        rows = self.table_template.extract(layout.page, detect=lambda page: page.find_tables()[0])
+        raw_data = self._remove_empty_items(rows)    # remove things like ["", None, None, None, None]
                 
         df_item = self._get_item_df(raw_data)
         df_item = df_item[df_item["Désignation"] != "FRAISTRANSPORT"]
@@ -159,7 +204,7 @@ class JessyFactureReader:
         return output_list
 
     def _get_item_df(self, raw_data: List) -> pd.DataFrame:
-        item_to_match = ['Désignation', 'Quantité', 'P.U. HT', '% REM', 'Remise HT', 'Montant HT']
+        item_to_match = self.item_header
         array = np.array(raw_data)
         if array.shape == (2, len(item_to_match)):
             if raw_data[0] == item_to_match:
@@ -167,10 +212,7 @@ class JessyFactureReader:
                 data = self._prepare_data_for_item_df(result_dict=result_dict, raw_1_data=raw_data[1])
                 df = pd.DataFrame(data)
                 numeric_columns = ['Quantité', 'P.U. HT', '% REM', 'Remise HT', 'Montant HT']
-                for col in numeric_columns:
-                    df[col] = df[col].str.replace(',', '.')
-                    df[col] = df[col].str.replace(' ', '')
-                    df[col] = df[col].astype(float)
+                df = parse_french_numbers(df, numeric_columns)
                 df['remis_check'] = (df['Quantité'] * df['P.U. HT'] * df['% REM']/100).round(2) == df['Remise HT']
                 # round Montant HT
                 df['Montant HT'] = df['Montant HT'].round()
@@ -193,27 +235,33 @@ class JessyFactureReader:
             easy_mode = True
         else:
             easy_mode = False
+        if self.strategy == "flip_mode":
+            easy_mode = not easy_mode   # the other mode, when the guess was wrong
         logger.info(f"easy mode: {easy_mode}")
         output = {}
         for x, y in result_dict.items():
             y_raw_list = y.split("\n")
             if x == "Désignation":
-                words_to_remove = ["HS", "ELASTAIN", "POLIESTER", "ACRYLIQUE", "elasatin"]
                 y_raw_list_des = [i.replace("FRAIS TRANSPORT", "FRAISTRANSPORT") for i in y_raw_list if not ("ORIGIN" in i or "SHIPPER" in i or "GOODS" in i)]  # remove item des like ORIGIN OF THE GOODS : ITALY
                 y = "\n".join(y_raw_list_des)
                 if easy_mode == False:
-                    output[x] = self.hard_mode_extract_des(y, words_to_remove)
+                    output[x] = self.hard_mode_extract_des(y)
                 else:
                     output[x] = y_raw_list_des
             else:
                 output[x] = self.extend_or_short_list(y_raw_list, number_of_items)
         return output
 
-    def hard_mode_extract_des(self, y, words_to_remove):
-        remove_pattern = r"\b(" + "|".join(words_to_remove) + r")\b"
-        cleaned_text = re.sub(remove_pattern, "", y, flags=re.IGNORECASE)
-        cleaned_text = re.sub(r"(?i)(TUNIQUE)(\d+)", r"TUNIQUE \2", cleaned_text)  # Ensure "TUNIQUE" is followed by a space and number
-        return re.findall(r"\b[A-Za-z]+[0-9]?\b", cleaned_text)
+    def hard_mode_extract_des(self, y):
+        # one pass over the description: words, minus words_to_remove, and "TUNIQUE" cut from the number glued to it
+        words = []
+        for match in self.patterns["description_word"].finditer(y):
+            tunique_prefix, word = match.groups()
+            if word is None:
+                words.append(tunique_prefix + "TUNIQUE")
+            elif word.upper() not in self.words_to_remove:
+                words.append(word)
+        return words
 
 
     def extend_or_short_list(self, input_list, target_length, pad_value="0"):
@@ -227,12 +275,12 @@ class JessyFactureReader:
     def _get_dest_code(self, tva:str, dest_country:str) -> str:
         output = None
         if tva:
-            chars_only = re.match(r'^[A-Za-z]+', tva)
+            chars_only = self.patterns["country_code"].match(tva)
             if chars_only:
                 output = chars_only.group()  # Extract the matched part
                 if output == "ESB":
                     output = "ES"
-            elif re.match(r'^[0-9]{5}$', tva):
+            elif self.patterns["postal_code"].match(tva):
                 output = "FR"
             else:
                 logger.error(f"No alphabetic characters at the start for {tva}")
@@ -264,8 +312,7 @@ class JessyFactureReader:
         output_list = []
         for index, data in df.iterrows():
             item_number = index + 1
-            article_name=data["Désignation"]
-            cn8 = self._get_cn8(article_name=article_name)
+            cn8 = self._get_cn8(cn8_code=data["CODE"])
             if not cn8:
                 logger.error(f"Error while creating item for \n{data}")
                 logger.error(f"Skipped")
@@ -280,7 +327,7 @@ class JessyFactureReader:
                 CN8=cn8,
                 MSConsDestCode=self._get_dest_code(data["N° TVA"], data["dest_country"]),
                 countryOfOriginCode="IT",
-                netMass=round(self._get_weight(article_name=article_name) * data["Quantité"]),
+                netMass=round(self._get_weight(weight=data["POIDS/ARTICLE"]) * data["Quantité"]),
                 quantityInSU=data["Quantité"],
                 invoicedAmount=invoicedAmount,
                 statisticalProcedureCode=21,
@@ -302,6 +349,7 @@ class JessyFactureReader:
         has_no_nulls = not df['Facture N°'].isnull().any()
         if not has_no_nulls:
             raise ValueError(f"Got df with null value in column Facture N°")    # make sure Facture N° is not empty
+        df = self._add_article_info(df=df)
         declarations = []
         for _, group_data in df.groupby("Facture N°"):     # each facture is 1 declaration
             metadata_dict = group_data.iloc[0]
@@ -323,16 +371,22 @@ class JessyFactureReader:
         return declarations
 
 
-    def _get_cn8(self, article_name:str) -> Union[CN8, None]:
-        cn8_code = self.article_info.get_article_info(article_name=article_name, target_col='CODE')
+    def _add_article_info(self, df:pd.DataFrame) -> pd.DataFrame:
+        # CODE & POIDS/ARTICLE of each item, the distinct articles of the pdf are resolved once
+        article_info = self.article_info.resolve_many(df["Désignation"])
+        df = df.copy()
+        df["CODE"] = article_info["CODE"].to_numpy()
+        df["POIDS/ARTICLE"] = article_info["POIDS/ARTICLE"].to_numpy()
+        return df
+
+    def _get_cn8(self, cn8_code) -> Union[CN8, None]:
         if cn8_code:
             cn8 = CN8(
                 CN8Code=str(cn8_code)
             )
             return cn8
     
-    def _get_weight(self, article_name:str) -> float:
-        weight = self.article_info.get_article_info(article_name = article_name, target_col='POIDS/ARTICLE')
+    def _get_weight(self, weight) -> float:
         if weight:
             return weight
         else:
@@ -0,0 +1,42 @@
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# thousands separators (space, no-break space, narrow no-break space) and units around the amounts
+NUMBER_NOISE_PATTERN = "[ \u00a0\u202f€%]"
+
+
+class NumberParseError(ValueError):
+    """Cells that are not French-formatted numbers, as (row position, column, raw value)."""
+
+    def __init__(self, bad_cells:List[Tuple[int, str, str]]) -> None:
+        self.bad_cells = bad_cells
+        cells = ", ".join(f"row {row} {column}: {value!r}" for row, column, value in bad_cells)
+        super().__init__(f"{len(bad_cells)} cells are not numbers: {cells}")
+
+
+def parse_french_numbers(df:pd.DataFrame, columns:List[str], errors:str = "raise") -> pd.DataFrame:
+    """
+    Converts the columns of df from French-formatted text ("1 234,56", "12,50 €", "10,00 %") to float, all cells in one pass.
+    The cells that don't parse are reported together by row position and column:
+    raised as NumberParseError (errors="raise") or left as NaN (errors="coerce"). Missing cells (None) stay NaN.
+    """
+    if df.empty:
+        return df.astype({col: float for col in columns})
+    raw = pd.Series(df[columns].to_numpy(dtype=object).ravel(order="F"), dtype="string")
+    cleaned = raw.str.replace(NUMBER_NOISE_PATTERN, "", regex=True).str.replace(",", ".", regex=False)
+    values = pd.to_numeric(cleaned, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    bad = np.flatnonzero(raw.notna().to_numpy() & np.isnan(values))
+    if len(bad) and errors == "raise":
+        n_rows = len(df)
+        raise NumberParseError([(int(i % n_rows), columns[i // n_rows], raw.iloc[i]) for i in bad])
+    df = df.copy()
+    for index, col in enumerate(columns):
+        df[col] = values[index * len(df):(index + 1) * len(df)]
+    return df
+
+
+def parse_french_number(text:str) -> float:
+    # single amount, like a remise found in the page text
+    return float(parse_french_numbers(pd.DataFrame({"value": [text]}), ["value"])["value"].iloc[0])
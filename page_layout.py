@@ -0,0 +1,78 @@
+from collections import defaultdict
+from math import floor
+from typing import Dict, Iterator, List, Tuple
+
+from pdfplumber import utils
+from pdfplumber.page import test_proposed_bbox
+
+
+class GridIndex:
+    """
+    Uniform grid over the bounding boxes of page objects (the chars), built once per page.
+    query(bbox) returns the objects touching the cells covered by bbox, in their original page order,
+    so a region lookup only looks at the objects around the region instead of all the objects of the page.
+    """
+
+    def __init__(self, objects:List[Dict], cell_size:float = 24.0) -> None:
+        self.objects = objects
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        for index, obj in enumerate(objects):
+            for cell in self._iter_cells((obj["x0"], obj["top"], obj["x1"], obj["bottom"])):
+                self._cells[cell].append(index)
+
+    def _iter_cells(self, bbox:Tuple[float, float, float, float]) -> Iterator[Tuple[int, int]]:
+        # bounds are inclusive, objects only touching the bbox border are kept like in pdfplumber's crop
+        x0, top, x1, bottom = bbox
+        for row in range(floor(top / self.cell_size), floor(bottom / self.cell_size) + 1):
+            for col in range(floor(x0 / self.cell_size), floor(x1 / self.cell_size) + 1):
+                yield (row, col)
+
+    def query(self, bbox:Tuple[float, float, float, float]) -> List[Dict]:
+        indices = set()
+        for cell in self._iter_cells(bbox):
+            indices.update(self._cells.get(cell, ()))
+        return [self.objects[i] for i in sorted(indices)]
+
+
+class PageLayout:
+    """
+    Text layout of one pdf page, extracted once and shared by all the bounding box lookups of a reader.
+    lines_in(bbox) gives the same lines as page.crop(bbox).extract_text_lines(), without clipping every rect, line and curve of the page for each crop.
+    """
+
+    def __init__(self, page) -> None:
+        self.page = page
+        self.page_number = page.page_number
+        self.bbox = page.bbox
+        self._chars = None
+        self._text = None
+        self._char_index = None
+
+    @property
+    def chars(self) -> List[Dict]:
+        if self._chars is None:
+            self._chars = self.page.chars
+        return self._chars
+
+    @property
+    def char_index(self) -> GridIndex:
+        if self._char_index is None:
+            self._char_index = GridIndex(self.chars)
+        return self._char_index
+
+    def text(self) -> str:
+        # same as page.extract_text_simple()
+        if self._text is None:
+            self._text = utils.extract_text_simple(self.chars)
+        return self._text
+
+    def lines_in(self, bbox:Tuple[float, float, float, float]) -> List[Dict]:
+        test_proposed_bbox(bbox, self.bbox)     # same check as page.crop, raise if bbox is not within the page
+        # the index only gives the candidate chars around bbox, crop_to_bbox still does the exact filtering & clipping
+        return self._extract_text_lines(utils.crop_to_bbox(self.char_index.query(bbox), bbox), bbox)
+
+    def _extract_text_lines(self, chars:List[Dict], bbox:Tuple[float, float, float, float]) -> List[Dict]:
+        x0, top, x1, bottom = bbox
+        textmap = utils.chars_to_textmap(chars, layout_bbox=bbox, layout_width=x1 - x0, layout_height=bottom - top)
+        return textmap.extract_text_lines(strip=True, return_chars=True)
@@ -0,0 +1,310 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple, Union
+import traceback
+
+from loguru import logger
+import pandas as pd
+
+from extraction_backend import open_pdf
+from invoice_state import InvoicePage
+
+
+class PageResult(NamedTuple):
+    page_number: int
+    df: Union[pd.DataFrame, None]     # None when the page gave no items
+    pages_to_double_check: List     # what the page added to the reader's pages to double check
+    page_reasons: Dict[int, str]
+    invoice_page: Union[InvoicePage, None] = None     # readers with an invoice state, df is set by their reduce step
+
+
+def split_page_indices(number_of_pages:int, number_of_chunks:int) -> List[range]:
+    # contiguous chunks, so concatenating the chunk results keeps the page order
+    number_of_chunks = max(1, min(number_of_chunks, number_of_pages))
+    chunk_size, remainder = divmod(number_of_pages, number_of_chunks)
+    chunks = []
+    start = 0
+    for i in range(number_of_chunks):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        chunks.append(range(start, end))
+        start = end
+    return chunks
+
+
+def iter_page_results(reader, pdf, page_indices:Iterable[int]) -> Iterator[PageResult]:
+    # moves what each page added to the reader's pages to double check into its PageResult, apply_page_results puts them back
+    page_iterator = reader._iter_page_results(pdf=pdf, page_indices=page_indices)
+    while True:
+        start = len(reader._pages_to_double_check)   # measured on each resume, the consumer may have applied results in between
+        try:
+            page_number, page_value = next(page_iterator)
+        except StopIteration:
+            return
+        pages_to_double_check = reader._pages_to_double_check[start:]
+        del reader._pages_to_double_check[start:]
+        page_reasons = {n: reader._page_reasons.pop(n) for n in pages_to_double_check if n in reader._page_reasons}
+        if isinstance(page_value, InvoicePage):
+            yield PageResult(page_number, None, pages_to_double_check, page_reasons, invoice_page=page_value)
+        else:
+            yield PageResult(page_number, page_value, pages_to_double_check, page_reasons)
+
+
+def reduce_page_results(reader, page_results:Iterable[PageResult]) -> Iterable[PageResult]:
+    # ordered pass resolving the invoice-level fields of readers with an invoice state, after the cache so only the page extraction is stored
+    if hasattr(reader, "_reduce_invoice_pages"):
+        return reader._reduce_invoice_pages(page_results)
+    return page_results
+
+
+def apply_page_results(reader, page_results:Iterable[PageResult]) -> Iterator[pd.DataFrame]:
+    for page_result in page_results:
+        reader._pages_to_double_check += page_result.pages_to_double_check
+        reader._page_reasons.update(page_result.page_reasons)
+        if page_result.df is not None:
+            yield page_result.df
+
+
+_worker_log_records = []     # log records of a worker process, sent back to the parent with the page results
+
+
+def _collect_worker_log(message) -> None:
+    record = message.record
+    text = record["message"]
+    if record["exception"] is not None:
+        text += "\n" + "".join(traceback.format_exception(*record["exception"]))
+    _worker_log_records.append({"level": record["level"].name, "message": text, "name": record["name"], "module": record["module"],
+                                "function": record["function"], "line": record["line"], "time": record["time"], "extra": record["extra"]})
+
+
+def _init_worker_log() -> None:
+    # worker processes don't have the sinks the parent added (under spawn), like the cli log file of the pdf,
+    # their records are collected instead, and logged again by the parent in its own sinks
+    logger.remove()
+    logger.add(_collect_worker_log, level="DEBUG")
+
+
+def _take_worker_log_records() -> List[Dict]:
+    records = list(_worker_log_records)
+    _worker_log_records.clear()
+    return records
+
+
+def log_worker_records(records:List[Dict]) -> None:
+    for item in records:
+        fields = {key: item[key] for key in ("name", "module", "function", "line", "time")}
+        logger.bind(**item["extra"]).patch(lambda record: record.update(fields)).log(item["level"], item["message"])
+
+
+def _extract_chunk(reader, page_indices:range) -> Tuple[Union[List[PageResult], Exception], List[Dict]]:
+    # runs in a worker process, reader is a pickled copy so its state stays local to the worker
+    try:
+        with open_pdf(reader) as pdf:
+            reader._pages_to_double_check = []
+            reader._page_reasons = {}
+            return list(iter_page_results(reader=reader, pdf=pdf, page_indices=page_indices)), _take_worker_log_records()
+    except Exception as e:
+        return e, _take_worker_log_records()
+
+
+def _watched_worker(reader, connection) -> None:
+    # runs in the PageWatchdog worker process: extracts each page index received, until None,
+    # every message is sent with the log records since the previous one
+    _init_worker_log()
+    try:
+        pdf = open_pdf(reader)
+    except Exception as e:
+        connection.send((e, _take_worker_log_records()))
+        return
+    with pdf:
+        reader._pages_to_double_check = []
+        reader._page_reasons = {}
+        connection.send(("ready", _take_worker_log_records()))     # started, modules imported and pdf opened, the page budget starts from here
+        while True:
+            page_index = connection.recv()
+            if page_index is None:
+                return
+            try:
+                page_result = next(iter_page_results(reader=reader, pdf=pdf, page_indices=[page_index]))
+            except Exception as e:
+                connection.send((e, _take_worker_log_records()))
+                return
+            connection.send((page_result, _take_worker_log_records()))
+
+
+class PageWatchdog:
+    """
+    Supervised worker process extracting the pages of a reader one at a time.
+    A page taking more than reader.page_time_budget seconds (or crashing the worker) is given up:
+    the worker is killed, the page is double checked with a timeout reason, and a new worker takes the next pages.
+    """
+
+    def __init__(self, reader) -> None:
+        self.reader = reader
+        self.process = None
+        self.connection = None
+
+    def __enter__(self) -> "PageWatchdog":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _start(self) -> None:
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_watched_worker, args=(self.reader, child_connection), daemon=True)
+        self.process.start()
+        child_connection.close()
+        # no deadline on the worker startup (spawn, imports, unpickling the reader, opening the pdf), only on the pages
+        try:
+            value, records = self.connection.recv()
+            log_worker_records(records)
+        except EOFError:
+            value = RuntimeError(f"extraction worker of {self.reader.pdf_name} exited before opening the pdf")
+        if value != "ready":
+            self.process.join()
+            self.connection.close()
+            self.process = None
+            raise value
+
+    def _kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.process = None
+
+    def extract(self, page_index:int) -> PageResult:
+        if self.process is None:
+            self._start()
+        budget = self.reader.page_time_budget
+        page_number = page_index + 1
+        self.connection.send(page_index)
+        if self.connection.poll(budget):
+            try:
+                value, records = self.connection.recv()
+                log_worker_records(records)
+            except EOFError:
+                value = None
+            if isinstance(value, PageResult):
+                return value
+            if isinstance(value, Exception):
+                self.close()
+                raise value
+            reason = "timeout, the extraction worker crashed"
+        else:
+            reason = f"timeout, extraction took more than {budget}s"
+        logger.error(f"page {page_number} given up, {reason}")
+        self._kill()
+        return PageResult(page_number, None, [page_number], {page_number: reason})
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.connection.send(None)
+        except OSError:     # worker already gone
+            pass
+        self.process.join()
+        self.connection.close()
+        self.process = None
+
+
+def iter_page_results_with_budget(reader, page_indices:Iterable[int]) -> Iterator[PageResult]:
+    with PageWatchdog(reader) as watchdog:
+        for page_index in page_indices:
+            yield watchdog.extract(page_index)
+
+
+def _extract_chunk_with_budget(reader, page_indices:range) -> Tuple[List[PageResult], List[Dict]]:
+    # runs in a thread, the pages themselves run in the watchdog worker process, which already logged its records
+    return list(iter_page_results_with_budget(reader=reader, page_indices=page_indices)), []
+
+
+def count_pages(reader) -> int:
+    with open_pdf(reader) as pdf:
+        return len(pdf.pages)
+
+
+def iter_page_results_in_pool(reader, workers:int) -> Iterator[PageResult]:
+    number_of_pages = count_pages(reader)
+    chunks = split_page_indices(number_of_pages, workers)
+    logger.info(f"extracting {number_of_pages} pages with {len(chunks)} workers")
+    if reader.page_time_budget:
+        # each thread supervises its own watchdog worker process
+        executor, extract_chunk = ThreadPoolExecutor(max_workers=len(chunks)), _extract_chunk_with_budget
+    else:
+        executor, extract_chunk = ProcessPoolExecutor(max_workers=len(chunks), initializer=_init_worker_log), _extract_chunk
+    with executor:
+        futures = [executor.submit(extract_chunk, reader, chunk) for chunk in chunks]
+        for future in futures:  # in page order
+            page_results, records = future.result()
+            log_worker_records(records)     # in the parent sinks, the cli log file of the pdf included
+            if isinstance(page_results, Exception):
+                raise page_results
+            yield from page_results
+
+
+def extract_page_numbers(reader, page_numbers:Iterable[int]) -> List[PageResult]:
+    # only the given pages, the invoice state of the readers that have one is resolved afterwards with the other pages
+    with open_pdf(reader) as pdf:
+        page_indices = []
+        for page_number in sorted(set(page_numbers)):
+            if 1 <= page_number <= len(pdf.pages):
+                page_indices.append(page_number - 1)
+            else:
+                logger.warning(f"page {page_number} not in {reader.pdf_name}, {len(pdf.pages)} pages")
+        if reader.page_time_budget:
+            return list(iter_page_results_with_budget(reader=reader, page_indices=page_indices))
+        return list(iter_page_results(reader=reader, pdf=pdf, page_indices=page_indices))
+
+
+def merge_page_results(page_results:Iterable[PageResult], new_page_results:List[PageResult]) -> Iterator[PageResult]:
+    new_page_results = {page_result.page_number: page_result for page_result in new_page_results}
+    for page_result in page_results:
+        yield new_page_results.get(page_result.page_number, page_result)
+
+
+def get_previous_pages_to_double_check(reader) -> List[int]:
+    page_results = reader.extraction_cache.get_page_results(reader=reader) if reader.extraction_cache else None
+    if page_results is None:
+        raise ValueError(f"no previous extraction of {reader.pdf_name} in the extraction cache, process the whole pdf first")
+    return sorted({page_number for page_result in reduce_page_results(reader=reader, page_results=page_results) for page_number in page_result.pages_to_double_check})
+
+
+def get_retried_page_results(reader) -> Iterable[PageResult]:
+    # the previous extraction of the pdf, with reader.page_numbers extracted again, stored back as the new extraction
+    cache = reader.extraction_cache
+    if cache is None:
+        raise ValueError("extracting again only some pages needs the extraction cache of a previous run")
+    page_results = cache.get_page_results(reader=reader)
+    if page_results is None:
+        raise ValueError(f"no previous extraction of {reader.pdf_name} in the extraction cache, process the whole pdf first")
+    logger.info(f"extracting again pages {reader.page_numbers} of {reader.pdf_name}, strategy: {reader.strategy}")
+    new_page_results = extract_page_numbers(reader=reader, page_numbers=reader.page_numbers)
+    return cache.record_page_results(reader=reader, page_results=merge_page_results(page_results, new_page_results))
+
+
+def iter_all_page_results(reader) -> Iterator[PageResult]:
+    if reader.workers > 1:
+        yield from iter_page_results_in_pool(reader=reader, workers=reader.workers)
+    elif reader.page_time_budget:
+        yield from iter_page_results_with_budget(reader=reader, page_indices=range(count_pages(reader)))
+    else:
+        with open_pdf(reader) as pdf:
+            yield from iter_page_results(reader=reader, pdf=pdf, page_indices=range(len(pdf.pages)))
+
+
+def get_page_results(reader) -> Iterable[PageResult]:
+    if reader.page_numbers:
+        return get_retried_page_results(reader=reader)
+    cache = reader.extraction_cache
+    if cache is None:
+        return iter_all_page_results(reader=reader)
+    page_results = cache.get_page_results(reader=reader)
+    if page_results is None:
+        page_results = cache.record_page_results(reader=reader, page_results=iter_all_page_results(reader=reader))
+    return page_results
+
+
+def iter_page_dfs(reader) -> Iterator[pd.DataFrame]:
+    # item DataFrame of each page, one page at a time
+    return apply_page_results(reader=reader, page_results=reduce_page_results(reader=reader, page_results=get_page_results(reader=reader)))
@@ -0,0 +1,62 @@
+from pathlib import Path
+from typing import Dict, Union
+import hashlib
+
+from loguru import logger
+
+from extraction_backend import TextPdf
+from extraction_cache import ExtractionCache
+
+DETECTION_VERSION = 1     # bump when score_reader or detect_company changes, to detect again the cached pdfs
+
+
+def read_first_page_text(pdf_path:Path) -> str:
+    # chars only, no rects/lines/curves and no other page
+    with TextPdf.open(pdf_path, pages=[1]) as pdf:
+        return pdf.pages[0].extract_text_simple()
+
+
+def score_reader(reader_class, text:str) -> Union[tuple, None]:
+    # None when the party name is not on the page, like the check the readers do on page 1,
+    # else the item table header cells and page keywords found, which tell SARL_ZHC and ZHC apart by their item tables,
+    # then the length of the party name, so a name found inside a longer matching one loses
+    party_name = reader_class.party.partyName
+    if party_name not in text:
+        return None
+    header_found = sum(cell in text for cell in getattr(reader_class, "item_header", []))
+    keywords_found = sum(keyword in text for keyword in reader_class.page_keywords)
+    return (header_found, keywords_found, len(party_name))
+
+
+def get_detection_key(func_mapping:Dict) -> str:
+    # detection version + what score_reader looks at in each reader, a cached company is only used with the same key
+    signature = repr(sorted(
+        (company_name, reader_class.party.partyName, getattr(reader_class, "item_header", []), reader_class.page_keywords)
+        for company_name, reader_class in func_mapping.items()
+    ))
+    return f"{DETECTION_VERSION}:{hashlib.sha256(signature.encode('utf-8')).hexdigest()[:16]}"
+
+
+def detect_company(pdf_path:Path, func_mapping:Dict, extraction_cache:ExtractionCache = None) -> str:
+    """
+    Company name (key of func_mapping) of the reader matching the first page of the pdf.
+    The result is cached per pdf hash and detection key when extraction_cache is given.
+    """
+    detection_key = get_detection_key(func_mapping)
+    if extraction_cache is not None:
+        company_name = extraction_cache.get_fingerprint(pdf_path, detection_key)
+        if company_name in func_mapping:
+            return company_name
+    text = read_first_page_text(pdf_path)
+    scores = {}
+    for company_name, reader_class in func_mapping.items():
+        score = score_reader(reader_class, text)
+        if score is not None:
+            scores[company_name] = score
+    if not scores:
+        raise ValueError(f"Company not detected in {pdf_path.name}, none of the party names of {', '.join(func_mapping.keys())} is on the first page")
+    company_name = max(scores, key=scores.get)
+    logger.info(f"detected company {company_name} for {pdf_path.name}, scores: {scores}")
+    if extraction_cache is not None:
+        extraction_cache.set_fingerprint(pdf_path, detection_key, company_name)
+    return company_name
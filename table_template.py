@@ -0,0 +1,121 @@
+from typing import Callable, Dict, List, Union
+
+from loguru import logger
+from pdfplumber.table import DEFAULT_JOIN_TOLERANCE, DEFAULT_SNAP_TOLERANCE
+
+
+class TableTemplate:
+    """
+    Item table of one supplier layout, pinned to explicit column and row lines.
+    The lines are learned from the first page where table detection finds the table with the expected header row,
+    the next pages are then extracted from the pinned lines directly, as long as the ruling drawn on the page is still the same.
+    Pages where the template doesn't fit fall back to detection, which learns the template again.
+    """
+
+    def __init__(self, header:List[str], tolerance:float = DEFAULT_SNAP_TOLERANCE) -> None:
+        self.header = header
+        self.tolerance = tolerance
+        self.vertical_lines = None     # x of the column borders
+        self.horizontal_lines = None   # top of the row borders
+
+    @property
+    def bbox(self) -> tuple:
+        return (self.vertical_lines[0], self.horizontal_lines[0], self.vertical_lines[-1], self.horizontal_lines[-1])
+
+    def extract(self, page, detect:Callable) -> List[List]:
+        # rows of the item table, detect(page) gives the table the reader would use without template
+        rows = self.pinned_rows(page)
+        if rows is not None:
+            return rows
+        table = detect(page)
+        rows = table.extract()
+        self.learn(table, rows)
+        return rows
+
+    def learn(self, table, rows:List[List]) -> None:
+        if self.header not in rows:
+            return
+        xs = sorted({cell[0] for cell in table.cells} | {cell[2] for cell in table.cells})
+        tops = sorted({cell[1] for cell in table.cells} | {cell[3] for cell in table.cells})
+        if len(table.cells) != (len(xs) - 1) * (len(tops) - 1):
+            # merged or partial cells, explicit lines would split them
+            logger.debug(f"table with header {self.header} is not a full grid, not pinned")
+            self.vertical_lines = self.horizontal_lines = None
+            return
+        self.vertical_lines = xs
+        self.horizontal_lines = tops
+
+    def pinned_rows(self, page) -> Union[List[List], None]:
+        # None when the template is not learned yet or doesn't fit the page
+        if self.vertical_lines is None:
+            return None
+        if not self._fits(page):
+            logger.debug(f"table template {self.header} doesn't fit page {page.page_number}, detecting tables")
+            return None
+        x0, top, x1, bottom = self.bbox
+        # explicit lines given as line objects, so they stop at the table borders instead of spanning the whole page
+        vertical_lines = [{"object_type": "line", "x0": x, "x1": x, "top": top, "bottom": bottom, "width": 0, "height": bottom - top} for x in self.vertical_lines]
+        horizontal_lines = [{"object_type": "line", "x0": x0, "x1": x1, "top": y, "bottom": y, "width": x1 - x0, "height": 0} for y in self.horizontal_lines]
+        tables = page.find_tables(table_settings={
+            "vertical_strategy": "explicit",
+            "horizontal_strategy": "explicit",
+            "explicit_vertical_lines": vertical_lines,
+            "explicit_horizontal_lines": horizontal_lines,
+        })
+        if len(tables) != 1:
+            return None
+        rows = tables[0].extract()
+        if self.header not in rows:
+            logger.debug(f"table template {self.header} doesn't match page {page.page_number} header, detecting tables")
+            return None
+        return rows
+
+    def _fits(self, page) -> bool:
+        # the edges drawn around the table must be the learned lines, nothing more or less,
+        # then detection would find the same cells, this only goes over the edges once instead of intersecting them
+        x0, top, x1, bottom = self.bbox
+        tol = self.tolerance
+        edges = page.edges
+        horizontal_edges = []
+        for edge in edges:
+            if edge["orientation"] != "h":
+                continue
+            if edge["x1"] - edge["x0"] < tol or edge["x1"] <= x0 + tol or edge["x0"] >= x1 - tol:
+                continue
+            if top - tol <= edge["top"] <= bottom + tol:
+                if edge["x0"] < x0 - tol or edge["x1"] > x1 + tol:
+                    return False    # ruling goes past the table, the table changed or is connected to another one
+                horizontal_edges.append(edge)
+        vertical_edges = []
+        for edge in edges:
+            if edge["orientation"] != "v":
+                continue
+            if edge["bottom"] - edge["top"] < tol or edge["bottom"] <= top + tol or edge["top"] >= bottom - tol:
+                continue
+            if x0 - tol <= edge["x0"] <= x1 + tol:
+                if edge["top"] < top - tol or edge["bottom"] > bottom + tol:
+                    return False
+                vertical_edges.append(edge)
+        return (
+            self._lines_match(horizontal_edges, self.horizontal_lines, "top", ("x0", "x1"), (x0, x1))
+            and self._lines_match(vertical_edges, self.vertical_lines, "x0", ("top", "bottom"), (top, bottom))
+        )
+
+    def _lines_match(self, edges:List[Dict], lines:List[float], position_key:str, span_keys:tuple, span:tuple) -> bool:
+        tol = self.tolerance
+        covered = {line: [] for line in lines}
+        for edge in edges:
+            line = min(lines, key=lambda line: abs(line - edge[position_key]))
+            if abs(line - edge[position_key]) > tol:
+                return False    # extra ruling, a row or column more than the template
+            covered[line].append((edge[span_keys[0]], edge[span_keys[1]]))
+        for segments in covered.values():
+            # each line is drawn across the whole table, gaps are joined like detection does
+            end = span[0] + tol
+            for start, stop in sorted(segments):
+                if start > end + DEFAULT_JOIN_TOLERANCE:
+                    return False
+                end = max(end, stop)
+            if end < span[1] - tol:
+                return False
+        return True
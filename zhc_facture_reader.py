@@ -1,10 +1,9 @@
 
 from pathlib import Path
-from typing import List, Union, Dict
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
 import re
 from datetime import datetime
 import warnings
-import pdfplumber
 from loguru import logger
 import pandas as pd
 import numpy as np
@@ -12,6 +11,12 @@ import pycountry
 
 from data_model import Party, Item_unit, Declaration_unit, CN8, Envelope, DateTime, Function, Instat
 from article_info import Article_Info
+from page_pool import iter_page_dfs
+from extraction_cache import ExtractionCache
+from extraction_backend import as_pdf_source, get_pdf_name
+from page_layout import PageLayout
+from table_template import TableTemplate
+from number_parser import parse_french_numbers
 
 
 class ZhcFactureReader:
@@ -24,14 +29,33 @@ class ZhcFactureReader:
     envelopeId = "L5BA"
     declarationTypeCode = 1     # 1 or 4 depends on company,
     if_xml: bool = True
+    page_keywords = ["Description"]     # pages without any of these words are skipped before find_tables
+    layout_version = 1     # bump when the page extraction changes, to invalidate the extraction cache
+    extraction_backend = "pdfplumber"     # full pages, find_tables needs their rects and lines
+    retry_strategies = []     # alternate ways to extract a page, for the pages to double check
+    page_time_budget = None     # seconds, pages taking longer are given up and double checked, None for no limit
+    patterns = {     # compiled once per class, the page and item loops only use these
+        "country_code": re.compile(r'([^\d]+)'),
+    }
+    item_header = ['Code', 'Description', 'Quantité', 'Prix HT', 'Total HT', 'Tx TVA']     # header row of the item table, the table template is pinned on it
 
-    def __init__(self, pdf_path:Path, article_info: Article_Info, output_folder_path:Path) -> None:
-        self.pdf_path = pdf_path
+    def __init__(self, pdf_path:Union[Path, bytes, BinaryIO], article_info: Article_Info, output_folder_path:Union[Path, None], workers:int = 1, extraction_cache:ExtractionCache = None, page_numbers:List[int] = None, strategy:str = None, page_time_budget:float = None, pdf_name:str = None) -> None:
+        self.pdf_path = as_pdf_source(pdf_path)     # path, or stream for a pdf kept in memory
+        self.pdf_name = pdf_name or get_pdf_name(self.pdf_path)
         self.article_info = article_info
-        self.output_xml_path = output_folder_path / f"{self.pdf_path.stem}.xml"
+        self.output_xml_path = output_folder_path / f"{Path(self.pdf_name).stem}.xml" if output_folder_path is not None else None     # None to keep the xml in memory only
+        self.xml_bytes = None
         self._previous_page_metadata = {}
         self._pages_to_double_check = []
+        self._page_reasons = {}    # page_number: reason, for pages skipped before extraction or given up
         self.df_item_all = None
+        self.workers = workers     # > 1 to extract pages in parallel worker processes
+        self.extraction_cache = extraction_cache     # reuse the page extraction of a previous run on the same pdf
+        self.page_numbers = page_numbers     # only extract again these pages, merged into the previous extraction in the cache
+        self.strategy = strategy     # one of retry_strategies, to extract again the pages to double check differently
+        if page_time_budget is not None:
+            self.page_time_budget = page_time_budget
+        self.table_template = TableTemplate(header=self.item_header)     # item table lines learned from the first detected table, skip detection on the next pages
         self.HEIGHT = 842
         self.WIDTH = 595
 
@@ -42,16 +66,17 @@ class ZhcFactureReader:
     def run(self) -> Union[pd.DataFrame, None]:
         instat = self.get_instat()
         df_envelope = instat.Envelope.to_df()   # not always match with df_item_all, because df_item could have item doesn't match code in data\DONNEES DOUANE PYTHON.xlsx
-        instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
+        self.xml_bytes = instat.export_to_xml(output_xml_path=self.output_xml_path, party_tag=self.party_tag)
         logger.warning(f"All page_numbers (skipped) to double check : {self._pages_to_double_check}")
-        instat.validate_xml(xml_file=self.output_xml_path)
+        if self._page_reasons:
+            logger.warning(f"Reasons of the skipped pages : {self._page_reasons}")
+        instat.validate_xml(xml_file=self.xml_bytes)
         if self.df_item_all is not None:
             return self.df_item_all
 
-    def _get_address_dict(self, page) -> Dict:
+    def _get_address_dict(self, layout:PageLayout) -> Dict:
         BOUNDING_BOX = (self.WIDTH * 0.42, self.HEIGHT * 0.08, self.WIDTH , self.HEIGHT * 0.30) 
-        corp_1 = page.crop(BOUNDING_BOX)
-        lines = corp_1.extract_text_lines()
+        lines = layout.lines_in(BOUNDING_BOX)
         country = None
         tva_number = None
         for x in lines:
@@ -74,16 +99,15 @@ class ZhcFactureReader:
             return "AT"
         if tva.startswith("EL"):
             return "GR"
-        match = re.match(r'([^\d]+)', tva)
+        match = self.patterns["country_code"].match(tva)
         if match:
             return match.group(1)
         else:
             raise ValueError(f"Invalid TVA format: {tva}")
 
-    def _get_corp_1_info(self, page) -> Dict:
+    def _get_corp_1_info(self, layout:PageLayout) -> Dict:
         BOUNDING_BOX_1 = (self.WIDTH * 3/8, 0, self.WIDTH , self.HEIGHT * 1 / 9) 
-        corp_1 = page.crop(BOUNDING_BOX_1)
-        lines = corp_1.extract_text_lines()
+        lines = layout.lines_in(BOUNDING_BOX_1)
         res = lines[-1]["text"].split(" ")
         facture_number, date, client = res
         corp_1_dict = {
@@ -94,51 +118,69 @@ class ZhcFactureReader:
         return corp_1_dict
 
     def get_instat(self) -> Instat:
-        with pdfplumber.open(self.pdf_path) as pdf:
-            dfs = []
-            for page_index, page in enumerate(pdf.pages):
-                text = page.extract_text_simple()
-                if page.page_number == 1:
-                    # just to double check if the pdf is matched with party name
-                    if self.party.partyName not in text:
-                        raise ValueError(f"{self.party.partyName} not found in {self.pdf_path}, page: {page.page_number}, probably wrong input pdf")
-                try:
-                    logger.info(f"extracting information from page number: {page.page_number}")
-                    df_item = self._get_full_df_from_page(page=page)
-                    logger.info(f"\n {df_item} \n")
-                    if not df_item.empty:
-                        # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
-                        is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
-                        # check if dest_country is FR(France) or not using starts with "FR" or "GB"
-                        is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("GB").any() or df_item['dest_country'].str.startswith("CH").any() or df_item['dest_country'].str.startswith("CHE").any() or df_item['dest_country'].str.startswith("PH").any()
-                        logger.debug(f"Checked is_good_tva: {is_good_tva}")
-                        if is_good_tva and not is_to_fr_or_gb:
-                            dfs.append(df_item)
-                        else:
-                            logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page.page_number}")
-                            self._pages_to_double_check.append(page.page_number)
+        dfs = iter_page_dfs(reader=self)
+        df = pd.concat(dfs, axis=0)
+        self.df_item_all = df.copy()
+        envelope = self._get_envelope(df=df)
+        instat = Instat(Envelope=envelope)
+        return instat
+
+    def _get_skip_reason(self, text:str) -> Union[str, None]:
+        # cheap check on the page text before find_tables & crops, boilerplate pages (terms and conditions, blank versos, ...) have no item table header
+        if not any(keyword in text for keyword in self.page_keywords):
+            return f"no item table header {self.page_keywords} found"
+
+    def _iter_page_results(self, pdf, page_indices) -> Iterator[Tuple[int, Union[pd.DataFrame, None]]]:
+        # (page_number, item DataFrame or None) for every page
+        for page_index in page_indices:
+            page = pdf.pages[page_index]
+            layout = PageLayout(page)
+            page_df = None
+            text = layout.text()
+            if page.page_number == 1:
+                # just to double check if the pdf is matched with party name
+                if self.party.partyName not in text:
+                    raise ValueError(f"{self.party.partyName} not found in {self.pdf_name}, page: {page.page_number}, probably wrong input pdf")
+            skip_reason = self._get_skip_reason(text)
+            if skip_reason:
+                logger.info(f"skipped page number: {page.page_number}, {skip_reason}")
+                self._pages_to_double_check.append(page.page_number)
+                self._page_reasons[page.page_number] = skip_reason
+                page.close()
+                yield page.page_number, None
+                continue
+            try:
+                logger.info(f"extracting information from page number: {page.page_number}")
+                df_item = self._get_full_df_from_page(layout=layout)
+                logger.info(f"\n {df_item} \n")
+                if not df_item.empty:
+                    # Check if all string lengths in the TVA column are greater than 3, which is a valid TVA
+                    is_good_tva = df_item['N° TVA'].str.len().gt(3).all()
+                    # check if dest_country is FR(France) or not using starts with "FR" or "GB"
+                    is_to_fr_or_gb = df_item['dest_country'].str.startswith("FR").any() or df_item['dest_country'].str.startswith("GB").any() or df_item['dest_country'].str.startswith("CH").any() or df_item['dest_country'].str.startswith("CHE").any() or df_item['dest_country'].str.startswith("PH").any()
+                    logger.debug(f"Checked is_good_tva: {is_good_tva}")
+                    if is_good_tva and not is_to_fr_or_gb:
+                        page_df = df_item
                     else:
+                        logger.warning(f"Skipped because N° TVA is not good or dest_country is FR or GB: {page.page_number}")
                         self._pages_to_double_check.append(page.page_number)
-                except Exception as e:
-                    logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
+                else:
                     self._pages_to_double_check.append(page.page_number)
-                    continue
-            df = pd.concat(dfs, axis=0)
-            self.df_item_all = df.copy()
-            envelope = self._get_envelope(df=df)
-            instat = Instat(Envelope=envelope)
-            return instat
+            except Exception as e:
+                logger.error(f"Error while processing page : {page.page_number}, skipped, error: {e}")
+                self._pages_to_double_check.append(page.page_number)
+            page.close()     # release the cached page objects, so memory doesn't grow with the number of pages
+            yield page.page_number, page_df
 
-    def _get_full_df_from_page(self, page) -> pd.DataFrame:
+    def _get_full_df_from_page(self, layout:PageLayout) -> pd.DataFrame:
 
-        metadata_dict = self._get_corp_1_info(page)
-        address_dict = self._get_address_dict(page)
+        metadata_dict = self._get_corp_1_info(layout)
+        address_dict = self._get_address_dict(layout)
         metadata_dict = {**metadata_dict, **address_dict}
-        metadata_dict["page_number"] = page.page_number
-        tables = page.find_tables()
-        table = tables[1]
-        logger.debug(f"table: {table.extract()}")
-        raw_data = self._remove_empty_items(table.extract())    # remove things like ["", None, None, None, None]
+        metadata_dict["page_number"] = layout.page_number
+        rows = self.table_template.extract(layout.page, detect=lambda page: page.find_tables()[1])
+        logger.debug(f"table: {rows}")
+        raw_data = self._remove_empty_items(rows)    # remove things like ["", None, None, None, None]
         df_item = self._get_item_df(raw_data)
         df_item = df_item[df_item["Description"] != "FRAIS DE TRANSPORT"]
         for k, v in metadata_dict.items():  # add metadata dict into df_items
@@ -162,14 +204,11 @@ class ZhcFactureReader:
         return output_list
 
     def _get_item_df(self, raw_data: List) -> pd.DataFrame:
-        item_to_match = ['Code', 'Description', 'Quantité', 'Prix HT', 'Total HT', 'Tx TVA']
+        item_to_match = self.item_header
         if len(raw_data) > 1:
             df = pd.DataFrame.from_records(raw_data[1:], columns=item_to_match)
             numeric_columns = ['Quantité', 'Prix HT', 'Total HT']
-            for col in numeric_columns:
-                df[col] = df[col].str.replace(',', '.')
-                df[col] = df[col].str.replace(' ', '')
-                df[col] = df[col].astype(float)
+            df = parse_french_numbers(df, numeric_columns)
             # round Total HT
             df['Total HT'] = df['Total HT'].round()
             return df
@@ -204,8 +243,7 @@ class ZhcFactureReader:
         output_list = []
         for index, data in df.iterrows():
             item_number = index + 1
-            article_name=data["Description"]
-            cn8 = self._get_cn8(article_name=article_name)
+            cn8 = self._get_cn8(cn8_code=data["CODE"])
             if not cn8:
                 logger.error(f"Error while creating item for \n{data}")
                 logger.error(f"Skipped")
@@ -217,7 +255,7 @@ class ZhcFactureReader:
                 CN8=cn8,
                 MSConsDestCode=data["dest_country"],
                 countryOfOriginCode="CN",
-                netMass=round(self._get_weight(article_name=article_name) * data["Quantité"]),
+                netMass=round(self._get_weight(weight=data["POIDS/ARTICLE"]) * data["Quantité"]),
                 quantityInSU=data["Quantité"],
                 invoicedAmount=invoicedAmount,
                 statisticalProcedureCode=21,
@@ -239,6 +277,7 @@ class ZhcFactureReader:
         has_no_nulls = not df['Facture N°'].isnull().any()
         if not has_no_nulls:
             raise ValueError(f"Got df with null value in column Facture N°")    # make sure Facture N° is not empty
+        df = self._add_article_info(df=df)
         declarations = []
         for _, group_data in df.groupby("Facture N°"):     # each facture is 1 declaration
             metadata_dict = group_data.iloc[0]
@@ -260,16 +299,22 @@ class ZhcFactureReader:
         return declarations
 
 
-    def _get_cn8(self, article_name:str) -> Union[CN8, None]:
-        cn8_code = self.article_info.get_article_info(article_name=article_name, target_col='CODE')
+    def _add_article_info(self, df:pd.DataFrame) -> pd.DataFrame:
+        # CODE & POIDS/ARTICLE of each item, the distinct articles of the pdf are resolved once
+        article_info = self.article_info.resolve_many(df["Description"])
+        df = df.copy()
+        df["CODE"] = article_info["CODE"].to_numpy()
+        df["POIDS/ARTICLE"] = article_info["POIDS/ARTICLE"].to_numpy()
+        return df
+
+    def _get_cn8(self, cn8_code) -> Union[CN8, None]:
         if cn8_code:
             cn8 = CN8(
                 CN8Code=str(cn8_code)
             )
             return cn8
     
-    def _get_weight(self, article_name:str) -> float:
-        weight = self.article_info.get_article_info(article_name = article_name, target_col='POIDS/ARTICLE')
+    def _get_weight(self, weight) -> float:
         if weight:
             return weight
         else: